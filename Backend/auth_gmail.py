@@ -1,4 +1,5 @@
 import os
+import sys
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -6,7 +7,7 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 # --- CONFIGURATION ---
 # ⚠️ Ensure this file matches the JSON file you downloaded from Google ⚠️
 GMAIL_CLIENT_SECRET_FILE = "client_secret_737666065056-4bsl0bsl9pcljbm0m3k2gtp2glkog8vc.apps.googleusercontent.com.json" 
-GMAIL_TOKEN_FILE = "gmail_token.json"
+GMAIL_TOKEN_FILE = sys.argv[1] if len(sys.argv) > 1 else "gmail_token.json" # one token file per mailbox
 GMAIL_SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
 # --- AUTH SCRIPT ---
@@ -0,0 +1,414 @@
+import argparse
+import base64
+import json
+import math
+import os
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import main
+from generate_data import LENGTH_PROFILES, generate_dataset
+from main import (
+    SUMMARIZER_CONFIG, GmailClient, ModelRegistry, SummaryQueue, SyncCheckpointStore, SyncRunLog,
+    _agent_assist, _apply_compliance, _default_insights, _load_embedder, _load_summarizer, _predict_labels,
+    _summarize_batch, ai_resources, extract_body, model_version_for, run_analysis_batch, run_analysis_pipeline,
+    sync_and_analyze_emails
+)
+
+# --- CONFIGURATION ---
+STAGES = ("embed", "classify", "summarize", "rules", "end_to_end")
+# expected_analysis field -> pipeline output it is checked against
+ACCURACY_FIELDS = {"category": "detected_intent", "sentiment": "detected_sentiment", "urgency": "predicted_priority"}
+# generate_data.py categories -> the intent classifier's labels (le_intent); praise and policy notices have no intent of their own
+CATEGORY_INTENTS = {"refund": "refund_request", "login": "account_access", "feature": "feature_request", "policy": "other", "praise": "other"}
+EXPECTED_LABELS = {"category": CATEGORY_INTENTS}
+MIME_FIXTURES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "mime_messages.json")
+
+# --- STUB BACKENDS ---
+class DatasetGmailClient(GmailClient):
+    """
+    Serves a generated corpus as Gmail messages, with no network calls.
+    Fixture messages (real-world MIME shapes) can be mixed in, along with the
+    attachment bodies they reference.
+    """
+
+    def __init__(self, dataset, page_size: int = 100, fixtures=()):
+        self.page_size = page_size
+        self.messages = {f"bench-{entry['id']}": self._to_message(entry) for entry in dataset}
+        self.attachments = {}
+        for fixture in fixtures:
+            self.messages[f"fixture-{fixture['name']}"] = fixture['message']
+            self.attachments.update(fixture.get('attachments', {}))
+        self.ids = list(self.messages)
+
+    @staticmethod
+    def _to_message(entry):
+        received = datetime.fromisoformat(entry['received_at'])
+        return {
+            "internalDate": str(int(received.timestamp() * 1000)),
+            "payload": {
+                "mimeType": "text/plain",
+                "headers": [{"name": "From", "value": entry['sender']}, {"name": "Subject", "value": entry['subject']}],
+                "body": {"data": base64.urlsafe_b64encode(entry['body'].encode("utf-8")).decode("ascii")},
+            },
+        }
+
+    def get_profile(self):
+        return {"historyId": "1"}
+
+    def list_message_ids(self, query: str, page_token: str = None):
+        start = int(page_token or 0)
+        end = start + self.page_size
+        return self.ids[start:end], (str(end) if end < len(self.ids) else None)
+
+    def list_history(self, start_history_id: str, page_token: str = None):
+        return [], None, start_history_id
+
+    def get_message(self, msg_id: str):
+        return self.messages[msg_id]
+
+    def get_attachment(self, msg_id: str, attachment_id: str):
+        return self.attachments[attachment_id]
+
+class _Result:
+    def __init__(self, data):
+        self.data = data
+
+class _MemoryQuery:
+    def __init__(self, database, table):
+        self.database = database
+        self.table = table
+        self.filters = []
+        self.rows = None
+        self.on_conflict = None
+        self.inner = []
+
+    def select(self, columns: str = "*", **kwargs):
+        # "child!inner(...)" keeps only rows that have a child row pointing at them by email_id
+        self.inner = re.findall(r"(\w+)!inner", columns)
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column, values):
+        values = set(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def upsert(self, rows, on_conflict: str = None, **kwargs):
+        self.rows, self.on_conflict = rows, on_conflict
+        return self
+
+    def execute(self):
+        with self.database.lock:
+            table = self.database.tables.setdefault(self.table, {})
+            if self.rows is None:
+                for child in self.inner:
+                    linked = {row.get('email_id') for row in self.database.tables.get(child, {}).values()}
+                    self.filters.append(lambda row, linked=linked: row.get('id') in linked)
+                return _Result([dict(row) for row in table.values() if all(f(row) for f in self.filters)])
+            written = []
+            for row in self.rows:
+                key = row[self.on_conflict]
+                stored = table.setdefault(key, {"id": self.database.next_id()})
+                stored.update(row)
+                written.append(dict(stored))
+            return _Result(written)
+
+class MemoryDatabase:
+    """The slice of the Supabase client the sync path uses, kept in memory."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = {}
+        self._ids = 0
+
+    def next_id(self):
+        self._ids += 1
+        return self._ids
+
+    def table(self, name: str):
+        return _MemoryQuery(self, name)
+
+# --- STATISTICS ---
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def latency_summary(seconds):
+    if not seconds:
+        return {"n": 0}
+    ordered = sorted(seconds)
+    total = sum(ordered)
+    return {
+        "n": len(ordered),
+        "mean_ms": round(statistics.mean(ordered) * 1000, 2),
+        "p50_ms": round(percentile(ordered, 50) * 1000, 2),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 2),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 2),
+        "throughput_per_s": round(len(ordered) / total, 2) if total else None,
+    }
+
+# --- BENCHMARKS ---
+def load_models(version, summarize):
+    registry = ModelRegistry()
+    registry.discover()
+    ai_resources['model_registry'] = registry
+    registry.activate(version or registry.default_version())
+    _load_embedder()
+    if summarize:
+        _load_summarizer()
+
+def bench_stages(dataset, summarize, warmup):
+    """Times every pipeline stage one email at a time, the way run_analysis_pipeline sees a single message."""
+    models = main.current_models()
+    embedder = ai_resources['embedder']
+    now = datetime.now()
+    samples = {stage: [] for stage in STAGES}
+
+    for n, entry in enumerate(dataset):
+        text = entry['body']
+        received = datetime.fromisoformat(entry['received_at'])
+        results = _default_insights()
+        timings = {}
+
+        start = time.perf_counter()
+        vecs = embedder.encode([text])
+        timings["embed"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        intents, sentiments, priorities = _predict_labels(models, vecs, [(now - received).total_seconds() / 3600])
+        timings["classify"] = time.perf_counter() - start
+        results.update(detected_intent=intents[0], detected_sentiment=sentiments[0], predicted_priority=priorities[0])
+
+        if summarize:
+            start = time.perf_counter()
+            _summarize_batch([text], [results], 1)
+            timings["summarize"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _apply_compliance(text, results)
+        _agent_assist(results)
+        timings["rules"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if summarize:
+            run_analysis_pipeline(text, received)
+        else:
+            run_analysis_batch([text], [received], summarize=False)
+        timings["end_to_end"] = time.perf_counter() - start
+
+        # The first calls pay for lazy initialization (kernels, tokenizer caches)
+        if n >= warmup:
+            for stage, seconds in timings.items():
+                samples[stage].append(seconds)
+    return {stage: latency_summary(values) for stage, values in samples.items() if values}
+
+def bench_batches(dataset, batch_size, summarize):
+    """Runs the batched pipeline over the corpus; returns the throughput report and the analyses for scoring."""
+    analyses, batch_seconds = [], []
+    for start in range(0, len(dataset), batch_size):
+        batch = dataset[start:start + batch_size]
+        began = time.perf_counter()
+        analyses.extend(run_analysis_batch(
+            [entry['body'] for entry in batch], [datetime.fromisoformat(entry['received_at']) for entry in batch],
+            summarize=summarize
+        ))
+        batch_seconds.append(time.perf_counter() - began)
+    report = latency_summary(batch_seconds)
+    report["batch_size"] = batch_size
+    report["throughput_per_s"] = round(len(dataset) / sum(batch_seconds), 2) if sum(batch_seconds) else None
+    return report, analyses
+
+def check_mime_fixtures(fixtures):
+    """Runs body extraction over the fixture corpus; reports failures and extraction latency."""
+    failures, seconds = [], []
+    for fixture in fixtures:
+        expect = fixture['expect']
+        began = time.perf_counter()
+        body = extract_body(fixture['message'], fixture.get('attachments', {}).get, fixture.get('max_bytes'))
+        seconds.append(time.perf_counter() - began)
+        problems = [f"source {body['source']!r} != {expect.get('source')!r}"] if body['source'] != expect.get('source') else []
+        problems += [f"missing {text!r}" for text in expect.get('contains', []) if text not in body['text']]
+        problems += [f"kept {text!r}" for text in expect.get('excludes', []) if text in body['text']]
+        if expect.get('empty') and body['text']:
+            problems.append("expected an empty body")
+        if 'truncated' in expect and body['truncated'] != expect['truncated']:
+            problems.append(f"truncated={body['truncated']}")
+        if len(body['text']) > expect.get('max_length', len(body['text'])):
+            problems.append(f"{len(body['text'])} characters kept")
+        if problems:
+            failures.append({"fixture": fixture['name'], "problems": problems})
+    return {"fixtures": len(fixtures), "passed": len(fixtures) - len(failures), "failures": failures, "extract": latency_summary(seconds)}
+
+def bench_sync(dataset, runs, drain_timeout, fixtures=()):
+    """End-to-end full syncs against the stub Gmail client and in-memory database."""
+    summary_queue = None
+    if main.SUMMARY_MODE == "async":
+        summary_queue = SummaryQueue()
+        summary_queue.start()
+        ai_resources['summary_queue'] = summary_queue
+    main.models_ready.set()
+
+    run_seconds, drain_seconds, stage_seconds = [], [], {}
+    with tempfile.TemporaryDirectory() as state_dir:
+        for n in range(runs):
+            ai_resources['db'] = MemoryDatabase()
+            main.sync_checkpoints = SyncCheckpointStore(os.path.join(state_dir, f"sync_state_{n}.json"))
+            main.sync_runs = SyncRunLog(None)
+            done_before = summary_queue.completed + summary_queue.failed if summary_queue else 0
+
+            began = time.perf_counter()
+            run = sync_and_analyze_emails(client=DatasetGmailClient(dataset, fixtures=fixtures))
+            run_seconds.append(time.perf_counter() - began)
+            if not run:
+                raise RuntimeError("Sync failed; see the log above.")
+            for stage, timing in run['timings'].items():
+                stage_seconds.setdefault(stage, []).append(timing['seconds'])
+
+            # In async mode the sync returns before summaries exist; time until the queue catches up too
+            if summary_queue is not None:
+                deadline = time.perf_counter() + drain_timeout
+                while summary_queue.completed + summary_queue.failed - done_before < run['stored'] and time.perf_counter() < deadline:
+                    time.sleep(0.05)
+                drain_seconds.append(time.perf_counter() - began)
+
+    report = latency_summary(run_seconds)
+    report["throughput_per_s"] = round((len(dataset) + len(fixtures)) * runs / sum(run_seconds), 2)
+    report["summary_mode"] = main.SUMMARY_MODE
+    report["stage_seconds_mean"] = {stage: round(statistics.mean(values), 3) for stage, values in stage_seconds.items()}
+    if drain_seconds:
+        report["until_summaries_done"] = latency_summary(drain_seconds)
+    return report
+
+def score(dataset, analyses):
+    """Accuracy against expected_analysis plus the most common confusions per field."""
+    report = {}
+    for field, output in ACCURACY_FIELDS.items():
+        confusions = {}
+        correct = 0
+        for entry, analysis in zip(dataset, analyses):
+            expected = entry['expected_analysis'][field]
+            expected = EXPECTED_LABELS.get(field, {}).get(expected, expected)
+            predicted = analysis['ai_insights'][output]
+            if predicted == expected:
+                correct += 1
+            else:
+                pair = f"{expected}->{predicted}"
+                confusions[pair] = confusions.get(pair, 0) + 1
+        report[field] = {
+            "accuracy": round(correct / len(dataset), 4) if dataset else None,
+            "top_confusions": dict(sorted(confusions.items(), key=lambda kv: -kv[1])[:5]),
+        }
+    return report
+
+def regressions(report, baseline, max_slowdown, max_accuracy_drop):
+    """Lists the p95 latencies and accuracies that got worse than the baseline report allows."""
+    found = []
+    for stage, current in report['stages'].items():
+        before = baseline.get('stages', {}).get(stage, {}).get('p95_ms')
+        if before and current.get('p95_ms') and current['p95_ms'] > before * (1 + max_slowdown):
+            found.append(f"{stage} p95 {before} ms -> {current['p95_ms']} ms")
+    for name in ("batch", "sync"):
+        before = baseline.get(name, {}).get('throughput_per_s')
+        current = report.get(name, {}).get('throughput_per_s')
+        if before and current and current < before / (1 + max_slowdown):
+            found.append(f"{name} throughput {before}/s -> {current}/s")
+    for field, current in report['accuracy'].items():
+        before = baseline.get('accuracy', {}).get(field, {}).get('accuracy')
+        if before is not None and current['accuracy'] is not None and current['accuracy'] < before - max_accuracy_drop:
+            found.append(f"{field} accuracy {before} -> {current['accuracy']}")
+    for failure in report.get('mime', {}).get('failures', []):
+        found.append(f"MIME fixture {failure['fixture']}: {'; '.join(failure['problems'])}")
+    return found
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline and the Gmail sync on a synthetic corpus.")
+    parser.add_argument("--dataset", default=None, help="Use an existing corpus instead of generating one.")
+    parser.add_argument("--count", type=int, default=200, help="Emails to generate.")
+    parser.add_argument("--length", default="mixed", choices=list(LENGTH_PROFILES), help="Body length distribution.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--version", default=None, help="Model version to benchmark. Defaults to the one the server would activate.")
+    parser.add_argument("--skip-summarize", action="store_true", help="Leave the summarizer out of every measurement.")
+    parser.add_argument("--batch-size", type=int, default=64, help="Emails per run_analysis_batch call.")
+    parser.add_argument("--sync-runs", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=3, help="Single-email runs left out of the statistics.")
+    parser.add_argument("--drain-timeout", type=float, default=600, help="Seconds to wait for async summaries per sync run.")
+    parser.add_argument("--mime-fixtures", default=MIME_FIXTURES_FILE, help="MIME fixture corpus, also mixed into the sync runs.")
+    parser.add_argument("--mime-only", action="store_true", help="Only check the MIME fixtures (no models are loaded); exits 1 on a failure.")
+    parser.add_argument("--output", default=None, help="Write the JSON report to this file.")
+    parser.add_argument("--baseline", default=None, help="Earlier report to compare against; exits 1 on a regression.")
+    parser.add_argument("--max-slowdown", type=float, default=0.2, help="Allowed fractional p95/throughput regression.")
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.02)
+    args = parser.parse_args()
+
+    with open(args.mime_fixtures) as f:
+        fixtures = json.load(f)
+    if args.mime_only:
+        mime = check_mime_fixtures(fixtures)
+        for failure in mime['failures']:
+            print(f"❌ MIME fixture {failure['fixture']}: {'; '.join(failure['problems'])}")
+        print(f"{'✅' if not mime['failures'] else '❌'} {mime['passed']}/{mime['fixtures']} MIME fixtures passed.")
+        sys.exit(1 if mime['failures'] else 0)
+
+    if args.dataset:
+        with open(args.dataset) as f:
+            dataset = json.load(f)
+        corpus = {"source": args.dataset}
+    else:
+        dataset = generate_dataset(args.count, args.length, args.seed)
+        corpus = {"source": "generated", "length": args.length, "seed": args.seed}
+    words = sorted(len(entry['body'].split()) for entry in dataset)
+    corpus.update(emails=len(dataset), words_p50=percentile(words, 50), words_p95=percentile(words, 95), words_max=words[-1])
+
+    summarize = not args.skip_summarize
+    print(f"⏳ Loading model version '{args.version or 'default'}'...")
+    load_models(args.version, summarize)
+    if not summarize:
+        main.SUMMARY_MODE = "inline" # nothing would ever drain the queue
+
+    print(f"⏳ Timing stages on {len(dataset)} emails...")
+    stages = bench_stages(dataset, summarize, args.warmup)
+    print("⏳ Timing batched analysis...")
+    batch, analyses = bench_batches(dataset, args.batch_size, summarize)
+    print(f"⏳ Checking {len(fixtures)} MIME fixtures...")
+    mime = check_mime_fixtures(fixtures)
+    print(f"⏳ Timing {args.sync_runs} end-to-end syncs...")
+    sync = bench_sync(dataset, args.sync_runs, args.drain_timeout, fixtures)
+
+    report = {
+        "generated_at": datetime.now().isoformat(),
+        "model_version": model_version_for(main.current_models()),
+        "summarizer": SUMMARIZER_CONFIG if summarize else None,
+        "device": ai_resources.get('device', "cpu"),
+        "corpus": corpus,
+        "stages": stages,
+        "batch": batch,
+        "sync": sync,
+        "accuracy": score(dataset, analyses),
+        "mime": mime,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        print(f"✅ Report saved to '{args.output}'")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.max_slowdown, args.max_accuracy_drop)
+        for line in found:
+            print(f"❌ Regression: {line}")
+        if found:
+            sys.exit(1)
+        print(f"✅ No regressions against '{args.baseline}'")
@@ -0,0 +1,124 @@
+import argparse
+import json
+import re
+import statistics
+import time
+
+from main import SUMMARIZER_PRESETS, SummarizerBackend, create_summarizer
+
+# --- CONFIGURATION ---
+DATASET_FILE = "sample_dataset.json"
+BASELINE = ("torch", "bart-large-samsum", 4)
+
+# name -> (backend, model, num_beams)
+CANDIDATES = {
+    "baseline": BASELINE,
+    "greedy": ("torch", "bart-large-samsum", 1),
+    "int8": ("torch-int8", "bart-large-samsum", 4),
+    "int8-greedy": ("torch-int8", "bart-large-samsum", 1),
+    "onnx": ("onnx", "bart-large-samsum", 4),
+    "distilbart": ("torch", "distilbart", 4),
+    "distilbart-int8-greedy": ("torch-int8", "distilbart", 1),
+}
+
+# --- ROUGE (F1, whitespace/punctuation tokenized) ---
+def _tokens(text):
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+def _ngrams(tokens, n):
+    counts = {}
+    for i in range(len(tokens) - n + 1):
+        gram = tuple(tokens[i:i + n])
+        counts[gram] = counts.get(gram, 0) + 1
+    return counts
+
+def _f1(overlap, candidate_total, reference_total):
+    if not overlap or not candidate_total or not reference_total:
+        return 0.0
+    precision = overlap / candidate_total
+    recall = overlap / reference_total
+    return 2 * precision * recall / (precision + recall)
+
+def rouge_n(candidate, reference, n):
+    cand, ref = _ngrams(_tokens(candidate), n), _ngrams(_tokens(reference), n)
+    overlap = sum(min(count, ref.get(gram, 0)) for gram, count in cand.items())
+    return _f1(overlap, sum(cand.values()), sum(ref.values()))
+
+def rouge_l(candidate, reference):
+    cand, ref = _tokens(candidate), _tokens(reference)
+    # Longest common subsequence, one row at a time
+    prev = [0] * (len(ref) + 1)
+    for c in cand:
+        row = [0]
+        for j, r in enumerate(ref):
+            row.append(prev[j] + 1 if c == r else max(prev[j + 1], row[j]))
+        prev = row
+    return _f1(prev[-1], len(cand), len(ref))
+
+# --- BENCHMARK ---
+def run_summarizer(summarizer: SummarizerBackend, texts, batch_size):
+    summaries, batch_seconds = [], []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        began = time.perf_counter()
+        summaries.extend(summarizer.summarize(batch, batch_size))
+        batch_seconds.append((time.perf_counter() - began) / len(batch))
+    return summaries, batch_seconds
+
+def compare(names, texts, batch_size):
+    report = {}
+    reference = None
+    for name in ["baseline"] + [n for n in names if n != "baseline"]:
+        backend, model, num_beams = CANDIDATES[name]
+        print(f"⏳ {name}: {backend} / {SUMMARIZER_PRESETS.get(model, model)} / beams={num_beams}")
+        try:
+            load_start = time.perf_counter()
+            summarizer = create_summarizer(backend, model, num_beams)
+            load_seconds = time.perf_counter() - load_start
+            summaries, per_email = run_summarizer(summarizer, texts, batch_size)
+        except Exception as e:
+            print(f"❌ {name} skipped: {e}")
+            report[name] = {"error": str(e)}
+            continue
+
+        if reference is None:
+            reference = summaries
+        report[name] = {
+            "backend": summarizer.describe(),
+            "load_seconds": round(load_seconds, 2),
+            "latency_per_email_ms": {
+                "mean": round(statistics.mean(per_email) * 1000, 1),
+                "median": round(statistics.median(per_email) * 1000, 1),
+            },
+            "rouge_vs_baseline": {
+                "rouge1": round(statistics.mean(rouge_n(c, r, 1) for c, r in zip(summaries, reference)), 4),
+                "rouge2": round(statistics.mean(rouge_n(c, r, 2) for c, r in zip(summaries, reference)), 4),
+                "rougeL": round(statistics.mean(rouge_l(c, r) for c, r in zip(summaries, reference)), 4),
+            },
+        }
+        baseline_ms = report.get("baseline", {}).get("latency_per_email_ms", {}).get("mean")
+        if baseline_ms:
+            report[name]["speedup_vs_baseline"] = round(baseline_ms / report[name]["latency_per_email_ms"]["mean"], 2)
+        print(f"✅ {name}: {report[name]['latency_per_email_ms']['mean']} ms/email, ROUGE-L {report[name]['rouge_vs_baseline']['rougeL']}")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare summarizer backends on latency and ROUGE against the current model.")
+    parser.add_argument("--dataset", default=DATASET_FILE)
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N emails.")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--candidates", nargs="+", default=list(CANDIDATES), choices=list(CANDIDATES))
+    parser.add_argument("--output", default=None, help="Write the JSON report to this file.")
+    args = parser.parse_args()
+
+    with open(args.dataset) as f:
+        texts = [entry["body"] for entry in json.load(f)][:args.limit]
+
+    report = compare(args.candidates, texts, args.batch_size)
+    output = json.dumps({"dataset": args.dataset, "emails": len(texts), "results": report}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        print(f"✅ Report saved to '{args.output}'")
+    else:
+        print(output)
@@ -1,9 +1,20 @@
+import argparse
 import json
 import random
 from datetime import datetime, timedelta
 
 # --- CONFIGURATION ---
 COUNT = 50  # How many emails you want
+OUTPUT_FILE = "sample_dataset.json"
+
+# Extra sentences appended to each templated body, drawn from a log-normal
+# distribution: name -> (median extra sentences, spread, chance of a quoted earlier reply)
+LENGTH_PROFILES = {
+    "template": (0, 0.0, 0.0),   # the bare one-line templates
+    "short": (2, 0.5, 0.0),
+    "mixed": (6, 1.0, 0.3),      # mostly short with a long tail, like a real inbox
+    "long": (40, 0.6, 0.6),      # long threads that exceed the summarizer's input window
+}
 
 # --- TEMPLATES ---
 senders = [
@@ -27,48 +38,110 @@ bodies = {
     "praise": "Just wanted to say thanks to the support agent who helped me with ticket #{ticket_id}. They were fast and polite."
 }
 
+filler = {
+    "refund": [
+        "I was charged twice and the second charge is still pending on my card.",
+        "Your chatbot keeps telling me the refund was processed but my bank shows nothing.",
+        "I have attached the bank statement and the order confirmation.",
+        "Please tell me exactly when the money will be credited back.",
+    ],
+    "login": [
+        "I cleared the cache and cookies and tried in an incognito window as well.",
+        "The reset email arrives but the link says it has expired.",
+        "My colleague on the same network can log in without any problem.",
+        "The error code shown is AUTH-403 after entering the OTP.",
+    ],
+    "feature": [
+        "Our team of twenty people would use this every single day.",
+        "Competitor tools already support this, so it would really help us stay.",
+        "Happy to join a call to walk you through our workflow.",
+        "Even a beta version behind a flag would be great.",
+    ],
+    "policy": [
+        "All teams must acknowledge the changes by the end of the week.",
+        "Section 4 describes the new retention periods for customer data.",
+        "Please route any questions through your compliance officer.",
+        "Non-compliance will be reported in the quarterly audit.",
+    ],
+    "praise": [
+        "I have been a customer for three years and this was the best experience so far.",
+        "Please pass my thanks on to the whole support team.",
+        "I will definitely recommend you to my friends.",
+        "The issue was fixed within an hour of raising the ticket.",
+    ],
+}
+signatures = ["\n\nThanks,\nAlex", "\n\nRegards,\nPriya Sharma\nSent from my iPhone", "\n\n--\nJordan Lee | Operations"]
+
 # --- GENERATOR LOGIC ---
-dataset = []
-
-for i in range(COUNT):
-    category = random.choice(list(subjects.keys()))
-    
-    # 1. Pick random details
-    sender = random.choice(senders)
-    subject = random.choice(subjects[category])
-    
-    # 2. Fill in the templates
-    body_template = bodies[category]
-    body = body_template.format(
-        days=random.randint(2, 30),
-        order_id=random.randint(1000, 9999),
-        feature="SSO Login",
-        policy="Data Privacy",
-        ticket_id=random.randint(10000, 99999)
-    )
-    
-    # 3. Assign expected labels (So you can check if the ML model is right later)
-    # This is your "Ground Truth"
-    expected_sentiment = "positive" if category == "praise" else ("angry" if category == "refund" else "neutral")
-    expected_urgency = "high" if category in ["refund", "policy"] else "medium"
-    
-    email_entry = {
-        "id": i + 1,
-        "sender": sender,
-        "subject": subject,
-        "body": body,
-        "received_at": (datetime.now() - timedelta(minutes=random.randint(1, 1000))).isoformat(),
-        "expected_analysis": {
-            "sentiment": expected_sentiment,
-            "urgency": expected_urgency,
-            "category": category
+def _pad_body(body, category, profile, rng):
+    """Grows a templated body to a length drawn from the profile."""
+    median, spread, quote_chance = LENGTH_PROFILES[profile]
+    if median == 0:
+        return body
+    extra = int(round(rng.lognormvariate(0, spread) * median))
+    sentences = [body] + [rng.choice(filler[category]) for _ in range(extra)]
+    paragraphs = [" ".join(sentences[i:i + 4]) for i in range(0, len(sentences), 4)]
+    text = "\n\n".join(paragraphs) + rng.choice(signatures)
+    if rng.random() < quote_chance:
+        quoted = "\n".join("> " + line for line in body.splitlines())
+        text += f"\n\nOn Mon, 3 Nov 2025 at 10:12, support@vendor.com wrote:\n{quoted}"
+    return text
+
+def generate_dataset(count: int = COUNT, length: str = "template", seed: int = None):
+    rng = random.Random(seed)
+    now = datetime.now()
+    dataset = []
+
+    for i in range(count):
+        category = rng.choice(list(subjects.keys()))
+
+        # 1. Pick random details
+        sender = rng.choice(senders)
+        subject = rng.choice(subjects[category])
+
+        # 2. Fill in the templates
+        body_template = bodies[category]
+        body = body_template.format(
+            days=rng.randint(2, 30),
+            order_id=rng.randint(1000, 9999),
+            feature="SSO Login",
+            policy="Data Privacy",
+            ticket_id=rng.randint(10000, 99999)
+        )
+        body = _pad_body(body, category, length, rng)
+
+        # 3. Assign expected labels (So you can check if the ML model is right later)
+        # This is your "Ground Truth"
+        expected_sentiment = "positive" if category == "praise" else ("angry" if category == "refund" else "neutral")
+        expected_urgency = "high" if category in ["refund", "policy"] else "medium"
+
+        email_entry = {
+            "id": i + 1,
+            "sender": sender,
+            "subject": subject,
+            "body": body,
+            "received_at": (now - timedelta(minutes=rng.randint(1, 1000))).isoformat(),
+            "expected_analysis": {
+                "sentiment": expected_sentiment,
+                "urgency": expected_urgency,
+                "category": category
+            }
         }
-    }
-    
-    dataset.append(email_entry)
+
+        dataset.append(email_entry)
+    return dataset
 
 # --- SAVE TO FILE ---
-with open("sample_dataset.json", "w") as f:
-    json.dump(dataset, f, indent=2)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a labelled synthetic email corpus.")
+    parser.add_argument("--count", type=int, default=COUNT)
+    parser.add_argument("--length", default="template", choices=list(LENGTH_PROFILES), help="Body length distribution.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for a reproducible corpus.")
+    parser.add_argument("--output", default=OUTPUT_FILE)
+    args = parser.parse_args()
+
+    dataset = generate_dataset(args.count, args.length, args.seed)
+    with open(args.output, "w") as f:
+        json.dump(dataset, f, indent=2)
 
-print(f"✅ Generated {COUNT} emails in 'sample_dataset.json'")
\ No newline at end of file
+    print(f"✅ Generated {args.count} emails in '{args.output}'")
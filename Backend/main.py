@@ -3,9 +3,12 @@ import random
 import joblib
 import numpy as np
 from datetime import datetime, timedelta 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Query, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
+from typing import Optional
 from supabase import create_client, Client
+from postgrest.exceptions import APIError
 from fastapi.middleware.cors import CORSMiddleware
 from sentence_transformers import SentenceTransformer
 import torch
@@ -13,6 +16,24 @@ from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 import base64
 import json
 import email
+import codecs
+import hashlib
+import html
+import sqlite3
+import threading
+import time
+import queue
+import itertools
+import re
+import zipfile
+import zlib
+import shutil
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 # --- NEW GMAIL IMPORTS ---
 from google.auth.transport.requests import Request
@@ -21,6 +42,18 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+# --- OPTIONAL: CROSS-PROCESS FILE LOCKS (NOT AVAILABLE ON WINDOWS) ---
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# --- OPTIONAL: APPROXIMATE NEAREST NEIGHBOUR BACKEND ---
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
 # --- CONFIGURATION ---
 # ⚠️ PASTE YOUR SUPABASE KEYS HERE ⚠️
 SUPABASE_URL = "https://ejhvwbxpgysqfyugbmqd.supabase.co"
@@ -28,11 +61,66 @@ SUPABASE_KEY = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJpc3MiOiJzdXBhYmFzZSIsInJ
 
 # --- PATHS ---
 MODEL_DIR = "models/"
-SUMMARIZER_MODEL_NAME = "philschmid/bart-large-cnn-samsum"
+MODEL_ROOT = os.getenv("MODEL_ROOT", ".") # where the `models*` directories and zips live
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", ".model_cache") # zipped versions are unpacked here
+DEFAULT_MODEL_VERSION = os.getenv("MODEL_VERSION", MODEL_DIR.rstrip("/"))
+SUMMARIZER_PRESETS = {
+    "bart-large-samsum": "philschmid/bart-large-cnn-samsum",
+    "distilbart": "sshleifer/distilbart-cnn-6-6",
+}
+SUMMARIZER_MODEL_NAME = SUMMARIZER_PRESETS.get(os.getenv("SUMMARIZER_MODEL_NAME"), os.getenv("SUMMARIZER_MODEL_NAME", SUMMARIZER_PRESETS["bart-large-samsum"]))
+SUMMARIZER_BACKEND = os.getenv("SUMMARIZER_BACKEND", "torch") # "torch", "torch-int8" or "onnx"
+SUMMARIZER_NUM_BEAMS = int(os.getenv("SUMMARIZER_NUM_BEAMS", "4")) # 1 = greedy decoding
+SUMMARY_BATCH_SIZE = int(os.getenv("SUMMARY_BATCH_SIZE", "8"))
+SUMMARY_STRATEGY = os.getenv("SUMMARY_STRATEGY", "chunked") # "chunked": strip quotes/signatures, map-reduce long emails; "truncate": first 1024 tokens
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "512")) # emails up to this many tokens are summarized in one pass
+SUMMARY_MAX_CHUNKS = int(os.getenv("SUMMARY_MAX_CHUNKS", "8")) # later chunks of very long emails are dropped
+SUMMARY_MIN_CHUNK_TOKENS = 256 # a chunk must hold at least two partial summaries (up to 100 tokens each) or reducing never converges
+SUMMARY_MAX_REDUCE_ROUNDS = int(os.getenv("SUMMARY_MAX_REDUCE_ROUNDS", "3")) # the last round summarizes the merged partials truncated
+SUMMARIZER_CONFIG = f"{SUMMARIZER_BACKEND}:{SUMMARIZER_MODEL_NAME}:beams={SUMMARIZER_NUM_BEAMS}:{SUMMARY_STRATEGY}"
+ANALYSIS_CACHE_PATH = os.getenv("ANALYSIS_CACHE_PATH", "analysis_cache.sqlite3")
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "10000"))
+EMBEDDING_DIM = 384 # all-MiniLM-L6-v2
+EMBEDDING_STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", "embeddings") # float16 vector per analyzed email
+RESOLVED_INDEX_BACKEND = os.getenv("RESOLVED_INDEX_BACKEND", "numpy") # "numpy" (exact) or "faiss" (approximate)
+RESOLVED_INDEX_ANN_MIN_SIZE = int(os.getenv("RESOLVED_INDEX_ANN_MIN_SIZE", "5000"))
+RESOLVED_MIN_SIMILARITY = float(os.getenv("RESOLVED_MIN_SIMILARITY", "0.3"))
+EMAILS_PAGE_SIZE = int(os.getenv("EMAILS_PAGE_SIZE", "100"))
+EMAILS_MAX_PAGE_SIZE = int(os.getenv("EMAILS_MAX_PAGE_SIZE", "1000"))
 GMAIL_CLIENT_SECRET_JSON = os.getenv("GOOGLE_CLIENT_SECRET")
 GMAIL_REFRESH_TOKEN = os.getenv("GOOGLE_REFRESH_TOKEN")
 GMAIL_ACCESS_TOKEN = os.getenv("GOOGLE_ACCESS_TOKEN")
 GMAIL_SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
+GMAIL_TOKEN_FILE = os.getenv("GMAIL_TOKEN_FILE", "gmail_token.json")
+GMAIL_PAGE_SIZE = int(os.getenv("GMAIL_PAGE_SIZE", "100"))
+SYNC_STATE_FILE = os.getenv("SYNC_STATE_FILE", "sync_state.json")
+FULL_SYNC_DAYS = int(os.getenv("FULL_SYNC_DAYS", "3"))
+DEFAULT_MAILBOX = "me"
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", "200000")) # decoded body text kept per email; the rest is never decoded
+GMAIL_FETCH_CONCURRENCY = int(os.getenv("GMAIL_FETCH_CONCURRENCY", "8"))
+GMAIL_MAX_RETRIES = int(os.getenv("GMAIL_MAX_RETRIES", "5"))
+GMAIL_BACKOFF_BASE = float(os.getenv("GMAIL_BACKOFF_BASE", "0.5")) # seconds
+INFERENCE_LINGER_SECONDS = float(os.getenv("INFERENCE_LINGER_SECONDS", "0.2"))
+DB_WRITE_CHUNK_SIZE = int(os.getenv("DB_WRITE_CHUNK_SIZE", "500"))
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "async") # "async": save labels first, summarize in the background; "inline": wait for summaries
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "1"))
+SHADOW_MODEL_VERSION = os.getenv("SHADOW_MODEL_VERSION") # candidate version scored in the background; unset disables shadow mode
+SHADOW_SAMPLE_RATE = float(os.getenv("SHADOW_SAMPLE_RATE", "0.1"))
+SHADOW_MAX_PENDING = int(os.getenv("SHADOW_MAX_PENDING", "32")) # queued shadow batches before samples are dropped
+RULES_FILE = os.getenv("RULES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json"))
+RULES_RELOAD_INTERVAL = float(os.getenv("RULES_RELOAD_INTERVAL", "5")) # seconds between rules-file change checks
+MODEL_READY_TIMEOUT = float(os.getenv("MODEL_READY_TIMEOUT", "600")) # seconds a sync waits for startup loading
+SYNC_RUNS_FILE = os.getenv("SYNC_RUNS_FILE", "sync_runs.jsonl")
+SYNC_RUN_HISTORY = int(os.getenv("SYNC_RUN_HISTORY", "100")) # finished runs kept queryable by run id
+MAILBOXES_FILE = os.getenv("MAILBOXES_FILE", "mailboxes.json") # [{"name", "token_file", "interval_seconds", "quota_units_per_second", "quota_burst"}]; no file = just DEFAULT_MAILBOX
+SYNC_INTERVAL_SECONDS = float(os.getenv("SYNC_INTERVAL_SECONDS", "0")) # periodic sync interval for mailboxes that don't set one; 0 = manual only
+SYNC_MAX_CONCURRENT_MAILBOXES = int(os.getenv("SYNC_MAX_CONCURRENT_MAILBOXES", "4"))
+SCHEDULER_TICK_SECONDS = float(os.getenv("SCHEDULER_TICK_SECONDS", "1"))
+GMAIL_QUOTA_UNITS_PER_SECOND = float(os.getenv("GMAIL_QUOTA_UNITS_PER_SECOND", "250")) # Gmail's per-user limit
+GMAIL_QUOTA_BURST = float(os.getenv("GMAIL_QUOTA_BURST", str(GMAIL_QUOTA_UNITS_PER_SECOND)))
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1")) # model threads shared by every mailbox's sync
+INFERENCE_MAX_BATCH = int(os.getenv("INFERENCE_MAX_BATCH", "64")) # emails from concurrent syncs merged into one model call
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # seconds
 
 app = FastAPI(title="CodeBharat Live Mail Analytics")
 
@@ -43,6 +131,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # --- GLOBAL AI STATE ---
@@ -53,340 +142,3124 @@ class EscalationRequest(BaseModel):
     email_id: int
     user_role: str
 
+class ShadowConfig(BaseModel):
+    version: Optional[str] = None
+    sample_rate: float = SHADOW_SAMPLE_RATE
+
+# --- METRICS (PROMETHEUS TEXT FORMAT) ---
+class Metrics:
+    """
+    In-process counters and latency histograms, rendered in the Prometheus text
+    format by GET /metrics. Series are keyed by metric name plus label values.
+    """
+
+    HELP = {
+        "mail_stage_seconds": "Wall time of one pipeline stage call.",
+        "mail_classifier_seconds": "Wall time of one classifier head over a batch.",
+        "mail_db_seconds": "Wall time of one database request.",
+        "mail_sync_seconds": "Wall time of a whole Gmail sync run.",
+        "mail_stage_errors_total": "Pipeline stage calls that raised.",
+        "mail_fallback_summaries_total": "Summaries replaced by a fallback text.",
+        "mail_gmail_retries_total": "Gmail calls retried after a 429/5xx response.",
+        "mail_gmail_skipped_total": "Messages skipped because Gmail returned 404/410 (deleted since listed).",
+        "mail_emails_analyzed_total": "Emails run through the analysis pipeline.",
+        "mail_sync_runs_total": "Finished Gmail sync runs.",
+        "mail_empty_bodies_total": "Messages with no text body; inference was skipped.",
+        "mail_truncated_bodies_total": "Message bodies cut at MAX_BODY_BYTES.",
+        "mail_summary_inputs_total": "Texts sent to the summarizer, by kind (direct, chunk, reduce).",
+        "mail_summary_tokens_total": "Summarizer input tokens after cleanup, and an estimate of the raw body's tokens.",
+        "mail_rate_limit_wait_seconds": "Time a Gmail call waited for its mailbox's quota bucket.",
+        "mail_inference_calls_total": "Shared inference calls, by how many sync batches each one merged.",
+    }
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}   # (name, labels) -> value
+        self._histograms = {} # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self._gauges = {}     # name -> (help, fn returning {labels: value})
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += seconds
+
+    @contextmanager
+    def time(self, stage: str, metric: str = "mail_stage_seconds", **labels):
+        """Times the block into a histogram; an exception also bumps mail_stage_errors_total."""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("mail_stage_errors_total", stage=stage)
+            raise
+        finally:
+            self.observe(metric, time.perf_counter() - start, stage=stage, **labels)
+
+    def error(self, stage: str):
+        """Counts an error that was handled without raising (e.g. a fallback path)."""
+        self.inc("mail_stage_errors_total", stage=stage)
+
+    def gauge(self, name: str, help_text: str, fn):
+        """Registers a gauge read at scrape time; fn returns a number or {labels tuple: number}."""
+        self._gauges[name] = (help_text, fn)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(series)) for key, series in self._histograms.items())
+        described = set()
+
+        def describe(name, kind, help_text):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            describe(name, "counter", self.HELP.get(name, name))
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), series in histograms:
+            describe(name, "histogram", self.HELP.get(name, name))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {series[-1]}")
+            lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        for name, (help_text, fn) in sorted(self._gauges.items()):
+            try:
+                values = fn()
+            except Exception:
+                continue
+            if values is None:
+                continue
+            describe(name, "gauge", help_text)
+            for labels, value in (values.items() if isinstance(values, dict) else [((), values)]):
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.gauge("mail_summary_queue_depth", "Summaries waiting for a worker.",
+              lambda: ai_resources['summary_queue'].depth() if 'summary_queue' in ai_resources else None)
+metrics.gauge("mail_embedding_store_emails", "Emails with a stored embedding.",
+              lambda: len(ai_resources['embedding_store']) if 'embedding_store' in ai_resources else None)
+metrics.gauge("mail_component_ready", "1 once a startup component has loaded.",
+              lambda: {(("component", name),): int(status.get('state') == "ready") for name, status in load_status.items()})
+
 # --- 1. STARTUP: LOAD ALL BRAINS ---
-@app.on_event("startup")
-def load_ai_models():
-    print("⏳ Starting Analysis Engine...")
-    
+# Each component loads in its own thread; dependents wait only for what they need.
+load_status = {}
+_load_status_lock = threading.Lock()
+models_ready = threading.Event()
+READINESS_COMPONENTS = ("database", "embedder", "classifiers", "summarizer")
+
+def _load_database():
     # A. Connect to Supabase
-    try:
-        ai_resources['db'] = create_client(SUPABASE_URL, SUPABASE_KEY)
-        print("✅ Database Connected.")
-    except Exception as e:
-        print(f"❌ Database Error: {e}")
+    ai_resources['db'] = create_client(SUPABASE_URL, SUPABASE_KEY)
+    print("✅ Database Connected.")
+
+def _load_embedder():
+    ai_resources['embedder'] = SentenceTransformer('all-MiniLM-L6-v2')
+    print("✅ Embedder Loaded.")
 
+def _load_classifiers():
     # B. Load Classification Models
-    if not os.path.exists(MODEL_DIR):
-        print(f"⚠️ WARNING: '{MODEL_DIR}' not found. ML will fail.")
-    else:
+    registry = ai_resources['model_registry']
+    registry.discover()
+    version = registry.default_version()
+    if version != DEFAULT_MODEL_VERSION:
+        print(f"⚠️ WARNING: model version '{DEFAULT_MODEL_VERSION}' is missing or incomplete. Using '{version}'.")
+    registry.activate(version)
+    print("✅ Classification Models Loaded.")
+    if SHADOW_MODEL_VERSION:
         try:
-            ai_resources['embedder'] = SentenceTransformer('all-MiniLM-L6-v2')
-            ai_resources['m_intent'] = joblib.load(f"{MODEL_DIR}model_intent.pkl")
-            ai_resources['m_sentiment'] = joblib.load(f"{MODEL_DIR}model_sentiment.pkl")
-            ai_resources['m_priority'] = joblib.load(f"{MODEL_DIR}model_priority.pkl")
-            
-            ai_resources['le_intent'] = joblib.load(f"{MODEL_DIR}le_intent.pkl")
-            ai_resources['le_sentiment'] = joblib.load(f"{MODEL_DIR}le_sentiment.pkl")
-            ai_resources['le_priority'] = joblib.load(f"{MODEL_DIR}le_priority.pkl")
-            print("✅ Classification Models Loaded.")
+            shadow_evaluator.configure(SHADOW_MODEL_VERSION, SHADOW_SAMPLE_RATE)
+            print(f"✅ Shadow Mode: {SHADOW_MODEL_VERSION} on {SHADOW_SAMPLE_RATE:.0%} of traffic.")
         except Exception as e:
-            print(f"❌ Classification Load Error: {e}")
+            print(f"❌ Shadow Mode Error: {e}")
 
+def _load_summarizer():
     # C. Load Summarizer
+    print("⏳ Loading Summarizer...")
+    summarizer = create_summarizer()
+    ai_resources['device'] = summarizer.device
+    ai_resources['summarizer'] = summarizer
+    print(f"✅ Summarizer Loaded ({summarizer.describe()}) on {summarizer.device}.")
+
+def _open_analysis_cache():
+    # D. Open Analysis Cache
+    ai_resources['analysis_cache'] = AnalysisCache(ANALYSIS_CACHE_PATH, ANALYSIS_CACHE_MAX_ENTRIES)
+    print(f"✅ Analysis Cache Ready ({ANALYSIS_CACHE_PATH}).")
+
+def _open_embedding_store():
+    # E. Open Embedding Store
+    ai_resources['embedding_store'] = EmbeddingStore(EMBEDDING_STORE_DIR)
+    print(f"✅ Embedding Store Ready ({len(ai_resources['embedding_store'])} emails in {EMBEDDING_STORE_DIR}/).")
+
+def _start_summary_workers():
+    # F. Start Summary Workers (they wait for the summarizer on their own)
+    if SUMMARY_MODE != "async":
+        return
+    ai_resources['summary_queue'] = SummaryQueue()
+    ai_resources['summary_queue'].start()
+    requeued = requeue_pending_summaries(ai_resources['summary_queue'])
+    print(f"✅ Summary Workers Started ({requeued} pending summaries requeued).")
+
+def _build_resolved_index():
+    # G. Build Resolved Email Index
+    if 'db' not in ai_resources or 'embedder' not in ai_resources:
+        raise RuntimeError("Database or embedder unavailable.")
+    ai_resources['resolved_index'] = build_resolved_index()
+    print(f"✅ Resolved Email Index Built ({len(ai_resources['resolved_index'])} emails).")
+
+# name -> (loader, components it needs first)
+STARTUP_COMPONENTS = {
+    "database": (_load_database, ()),
+    "embedder": (_load_embedder, ()),
+    "classifiers": (_load_classifiers, ()),
+    "summarizer": (_load_summarizer, ()),
+    "analysis_cache": (_open_analysis_cache, ()),
+    "embedding_store": (_open_embedding_store, ()),
+    "summary_workers": (_start_summary_workers, ("database",)),
+    "resolved_index": (_build_resolved_index, ("database", "embedder", "classifiers", "analysis_cache", "embedding_store")),
+}
+
+def _set_load_status(name: str, **fields):
+    with _load_status_lock:
+        load_status[name] = {**load_status.get(name, {}), **fields}
+
+def _run_loader(name: str, loader, dependencies):
+    for dependency in dependencies:
+        dependencies[dependency].result()
+    _set_load_status(name, state="loading")
+    start = time.perf_counter()
     try:
-        print("⏳ Loading Summarizer...")
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        ai_resources['device'] = device
-        ai_resources['tokenizer'] = AutoTokenizer.from_pretrained(SUMMARIZER_MODEL_NAME)
-        ai_resources['summarizer'] = AutoModelForSeq2SeqLM.from_pretrained(SUMMARIZER_MODEL_NAME).to(device)
-        ai_resources['summarizer'].eval()
-        print(f"✅ Summarizer Loaded on {device}.")
+        loader()
+        _set_load_status(name, state="ready", seconds=round(time.perf_counter() - start, 2))
     except Exception as e:
-        print(f"❌ Summarizer Load Error: {e}")
+        print(f"❌ {name} Load Error: {e}")
+        _set_load_status(name, state="failed", seconds=round(time.perf_counter() - start, 2), error=str(e))
+
+def _load_all_components():
+    started = time.perf_counter()
+    # One thread per component so a dependent waiting on its futures never starves a loader
+    with ThreadPoolExecutor(max_workers=len(STARTUP_COMPONENTS), thread_name_prefix="model-load") as pool:
+        futures = {}
+        for name, (loader, needs) in STARTUP_COMPONENTS.items():
+            futures[name] = pool.submit(_run_loader, name, loader, {dep: futures[dep] for dep in needs})
+    models_ready.set()
+    print(f"✅ Analysis Engine Ready in {time.perf_counter() - started:.1f}s: "
+          + ", ".join(f"{name}={status.get('seconds')}s" for name, status in load_status.items()))
+
+@app.on_event("startup")
+def load_ai_models():
+    """Starts loading every component in the background so the app can serve requests immediately."""
+    print("⏳ Starting Analysis Engine...")
+    ai_resources['model_registry'] = ModelRegistry()
+    for name in STARTUP_COMPONENTS:
+        _set_load_status(name, state="pending")
+    threading.Thread(target=_load_all_components, name="model-loader", daemon=True).start()
+    sync_scheduler.start()
+
+def component_failed(name: str) -> bool:
+    with _load_status_lock:
+        return load_status.get(name, {}).get('state') == "failed"
+
+def is_ready() -> bool:
+    with _load_status_lock:
+        return all(load_status.get(name, {}).get('state') == "ready" for name in READINESS_COMPONENTS)
         
 # --- GMAIL AUTHENTICATION FUNCTION ---
-def get_gmail_service():
-    """Authenticates and returns the Gmail service object."""
+def get_gmail_service(token_file: str = GMAIL_TOKEN_FILE):
+    """Authenticates and returns the Gmail service object for the account in token_file."""
     creds = None
-    if os.path.exists(GMAIL_TOKEN_FILE):
-        creds = Credentials.from_authorized_user_file(GMAIL_TOKEN_FILE, GMAIL_SCOPES)
+    if os.path.exists(token_file):
+        creds = Credentials.from_authorized_user_file(token_file, GMAIL_SCOPES)
         
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             print("Refreshing GMail token...")
             creds.refresh(Request())
         else:
-            print(f"🔑 AUTH REQUIRED: Please run the 'auth_gmail.py' script manually to generate '{GMAIL_TOKEN_FILE}'.")
+            print(f"🔑 AUTH REQUIRED: Please run 'python auth_gmail.py {token_file}' manually to generate '{token_file}'.")
             return None # Cannot proceed without auth file
 
-        with open(GMAIL_TOKEN_FILE, 'w') as token:
+        with open(token_file, 'w') as token:
             token.write(creds.to_json())
 
     return build('gmail', 'v1', credentials=creds)
 
-# --- EMAIL PARSING HELPER ---
-def get_email_body(msg):
-    """Extracts the cleanest body text from a multi-part Gmail message."""
-    try:
-        if 'parts' in msg['payload']:
-            for part in msg['payload']['parts']:
-                if part['mimeType'] == 'text/plain':
-                    data = part['body']['data']
-                    return base64.urlsafe_b64decode(data).decode('utf-8')
-        elif msg['payload']['mimeType'] == 'text/plain':
-            data = msg['payload']['body']['data']
-            return base64.urlsafe_b64decode(data).decode('utf-8')
-        return "Body content extraction failed or is empty."
-    except Exception as e:
-        print(f"Parsing error: {e}")
-        return "Body extraction error."
+# --- GMAIL CLIENT INTERFACE (STUB-ABLE FOR OFFLINE SYNCS) ---
+class HistoryExpiredError(Exception):
+    """Raised when Gmail no longer has history for the stored checkpoint."""
 
-# --- VECTOR SEARCH FOR CACHING (NEW) ---
-def find_similar_resolved_emails(current_email_text: str, current_intent: str):
-    """Finds similarity between current email and previously resolved emails with matching intent."""
-    db = ai_resources.get('db')
-    if 'embedder' not in ai_resources or db is None or not current_intent or current_intent == 'unknown': return None
-    
+class GmailClient(ABC):
+    """The Gmail operations the sync needs. Subclass this to stub Gmail out in offline runs."""
+
+    @abstractmethod
+    def get_profile(self) -> dict:
+        ...
+
+    @abstractmethod
+    def list_message_ids(self, query: str, page_token: str = None):
+        """Returns (message_ids, next_page_token)."""
+
+    @abstractmethod
+    def list_history(self, start_history_id: str, page_token: str = None):
+        """Returns (added_message_ids, next_page_token, history_id). Raises HistoryExpiredError."""
+
+    @abstractmethod
+    def get_message(self, msg_id: str) -> dict:
+        ...
+
+    @abstractmethod
+    def get_attachment(self, msg_id: str, attachment_id: str) -> str:
+        """Returns the base64url data of a part stored behind an attachmentId."""
+
+class GoogleGmailClient(GmailClient):
+    """GmailClient backed by the real Gmail API service."""
+
+    SKIPPED_LABELS = {"SPAM", "TRASH", "DRAFT"}
+
+    def __init__(self, service, service_factory=None):
+        # httplib2 connections are not thread-safe, so worker threads build their own service
+        self._shared_service = service
+        self._service_factory = service_factory
+        self._owner_thread = threading.get_ident()
+        self._local = threading.local()
+
+    @property
+    def service(self):
+        if self._service_factory is None or threading.get_ident() == self._owner_thread:
+            return self._shared_service
+        if getattr(self._local, 'service', None) is None:
+            self._local.service = self._service_factory()
+        return self._local.service
+
+    def get_profile(self):
+        return self.service.users().getProfile(userId='me').execute()
+
+    def list_message_ids(self, query, page_token=None):
+        results = self.service.users().messages().list(
+            userId='me', q=query, maxResults=GMAIL_PAGE_SIZE, pageToken=page_token
+        ).execute()
+        return [m['id'] for m in results.get('messages', [])], results.get('nextPageToken')
+
+    def list_history(self, start_history_id, page_token=None):
+        try:
+            results = self.service.users().history().list(
+                userId='me', startHistoryId=start_history_id, historyTypes=['messageAdded'],
+                maxResults=GMAIL_PAGE_SIZE, pageToken=page_token
+            ).execute()
+        except HttpError as error:
+            if getattr(error, 'resp', None) is not None and error.resp.status == 404:
+                raise HistoryExpiredError(str(error))
+            raise
+        ids = []
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                msg = added['message']
+                if not self.SKIPPED_LABELS.intersection(msg.get('labelIds', [])):
+                    ids.append(msg['id'])
+        return list(dict.fromkeys(ids)), results.get('nextPageToken'), results.get('historyId')
+
+    def get_message(self, msg_id):
+        return self.service.users().messages().get(userId='me', id=msg_id).execute()
+
+    def get_attachment(self, msg_id, attachment_id):
+        return self.service.users().messages().attachments().get(
+            userId='me', messageId=msg_id, id=attachment_id
+        ).execute().get('data', "")
+
+class TokenBucket:
+    """Thread-safe token bucket: refills at `rate` per second up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = max(rate, 1e-6)
+        self.capacity = max(capacity or rate, 1.0)
+        self.waited = 0.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, cost: float = 1.0) -> float:
+        """Blocks until `cost` tokens are available and takes them. Returns the seconds spent waiting."""
+        cost = min(cost, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= cost:
+                    self._tokens -= cost
+                    self.waited += waited
+                    return waited
+                delay = (cost - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def available(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+class RateLimitedGmailClient(GmailClient):
+    """
+    Wraps a mailbox's GmailClient so every call first takes its Gmail quota
+    cost from that mailbox's token bucket. Retries are charged again, as Gmail does.
+    """
+
+    # Gmail API quota units per call
+    QUOTA_UNITS = {"get_profile": 1, "list_message_ids": 5, "list_history": 2, "get_message": 5, "get_attachment": 5}
+
+    def __init__(self, client: GmailClient, bucket: TokenBucket, mailbox: str = DEFAULT_MAILBOX):
+        self.client = client
+        self.bucket = bucket
+        self.mailbox = mailbox
+
+    def _take(self, call: str):
+        waited = self.bucket.acquire(self.QUOTA_UNITS[call])
+        if waited:
+            metrics.observe("mail_rate_limit_wait_seconds", waited, mailbox=self.mailbox)
+
+    def get_profile(self):
+        self._take("get_profile")
+        return self.client.get_profile()
+
+    def list_message_ids(self, query, page_token=None):
+        self._take("list_message_ids")
+        return self.client.list_message_ids(query, page_token)
+
+    def list_history(self, start_history_id, page_token=None):
+        self._take("list_history")
+        return self.client.list_history(start_history_id, page_token)
+
+    def get_message(self, msg_id):
+        self._take("get_message")
+        return self.client.get_message(msg_id)
+
+    def get_attachment(self, msg_id, attachment_id):
+        self._take("get_attachment")
+        return self.client.get_attachment(msg_id, attachment_id)
+
+class SyncCheckpointStore:
+    """Persists the last processed Gmail historyId per mailbox in a small JSON file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def get(self, mailbox: str):
+        with self._lock:
+            return self._read().get(mailbox, {}).get('history_id')
+
+    def set(self, mailbox: str, history_id: str):
+        with self._lock:
+            state = self._read()
+            state[mailbox] = {"history_id": str(history_id), "synced_at": datetime.now().isoformat()}
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+sync_checkpoints = SyncCheckpointStore(SYNC_STATE_FILE)
+
+def iter_full_sync_pages(client: GmailClient):
+    """Pages through every message of the last FULL_SYNC_DAYS days."""
+    since = int((datetime.now() - timedelta(days=FULL_SYNC_DAYS)).timestamp())
+    page_token = None
+    while True:
+        with metrics.time("gmail_list"):
+            ids, page_token = call_with_backoff(client.list_message_ids, f"after:{since}", page_token)
+        yield ids
+        if not page_token:
+            break
+
+def iter_history_pages(client: GmailClient, start_history_id: str, result: dict):
+    """Pages through messages added since start_history_id; the final historyId is left in result."""
+    page_token = None
+    while True:
+        with metrics.time("gmail_history"):
+            ids, page_token, history_id = call_with_backoff(client.list_history, start_history_id, page_token)
+        if history_id:
+            result['history_id'] = history_id
+        yield ids
+        if not page_token:
+            break
+
+def filter_unseen_message_ids(db, msg_ids):
+    """
+    Drops messages that are already stored, using one bulk query per page. A
+    message only counts as stored once its analysis row exists, so one whose
+    email_analysis write failed is fetched and analyzed again.
+    """
+    if not msg_ids:
+        return []
+    with metrics.time("dedup_query", "mail_db_seconds"):
+        response = db.table("emails").select(
+            "conversation_thread_id, email_analysis!inner(email_id)"
+        ).in_("conversation_thread_id", msg_ids).execute()
+    seen = {row['conversation_thread_id'] for row in response.data or []}
+    return [msg_id for msg_id in msg_ids if msg_id not in seen]
+
+# --- EMAIL PARSING HELPER (MIME BODY EXTRACTION) ---
+HTML_BLOCK_RE = re.compile(r"<(style|script|head)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+HTML_BREAK_RE = re.compile(r"<\s*(br|/p|/div|/li|/tr|/h[1-6])\b[^>]*>", re.IGNORECASE)
+HTML_TAG_RE = re.compile(r"<[^>]+>")
+CHARSET_RE = re.compile(r"charset\s*=\s*\"?([\w.:-]+)", re.IGNORECASE)
+
+def strip_html_tags(markup: str) -> str:
+    """Drops style/script blocks and tags, turning block-level breaks into newlines."""
+    markup = HTML_BLOCK_RE.sub(" ", markup)
+    markup = HTML_BREAK_RE.sub("\n", markup)
+    return HTML_TAG_RE.sub(" ", markup)
+
+def html_to_text(markup: str) -> str:
+    text = html.unescape(strip_html_tags(markup)).replace("\xa0", " ")
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+def _part_header(part, name):
+    name = name.lower()
+    for header in part.get('headers') or []:
+        if header.get('name', '').lower() == name:
+            return header.get('value', '')
+    return ""
+
+def _is_attachment(part):
+    return bool(part.get('filename')) or _part_header(part, 'Content-Disposition').lower().startswith('attachment')
+
+def _decode_part_data(data: str, charset: str, max_bytes: int):
+    """
+    Decodes base64url part data, cutting the encoded string first so no more
+    than max_bytes are ever decoded. Returns (text, bytes decoded, truncated).
+    """
+    limit = -(-max_bytes // 3) * 4 # 4 base64 characters per 3 bytes
+    truncated = len(data) > limit
+    data = data[:limit]
+    raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))[:max_bytes]
     try:
-        # 1. Fetch resolved issues (only those with resolution details)
-        response = db.table('email_analysis').select(
-            'final_resolution_details, resolved_at, extracted_entities'
-        ).eq('extracted_entities->>intent', current_intent).not_.is_('final_resolution_details', 'NULL').limit(1).execute()
-        
-        # We only need one example resolution
-        if response.data:
-            issue = response.data[0]
+        codecs.lookup(charset)
+    except LookupError:
+        charset = "utf-8"
+    return raw.decode(charset, errors="replace"), len(raw), truncated
+
+def _text_parts(payload):
+    """
+    Walks the MIME tree iteratively in document order and yields inline
+    text/plain and text/html leaves. Inside multipart/alternative only the
+    plain-text branch and the richest other branch are followed, plain first,
+    so the HTML is only decoded when the plain text turns out to be empty.
+    """
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        mime_type = (part.get('mimeType') or "").lower()
+        children = part.get('parts') or []
+        if children:
+            if mime_type == "multipart/alternative":
+                plain = [c for c in children if (c.get('mimeType') or "").lower() == "text/plain" and not _is_attachment(c)]
+                others = [c for c in children if c not in plain]
+                children = plain[:1] + others[-1:]
+            stack.extend(reversed(children))
+        elif mime_type in ("text/plain", "text/html") and not _is_attachment(part):
+            yield mime_type, part
+
+def extract_body(message: dict, fetch_attachment=None, max_bytes: int = None) -> dict:
+    """
+    Extracts the readable body of a Gmail API message. Plain-text parts win;
+    HTML is converted to text only when a message has no plain text. Parts
+    stored behind an attachmentId are fetched with fetch_attachment(id) when
+    given; errors from it propagate to the caller. A part that cannot be
+    decoded is skipped. At most max_bytes (MAX_BODY_BYTES) are decoded in total.
+    Returns {"text", "source" ("plain", "html" or None), "truncated"}.
+    """
+    budget = max_bytes or MAX_BODY_BYTES
+    found = {"text/plain": [], "text/html": []}
+    truncated = False
+    for mime_type, part in _text_parts(message.get('payload') or {}):
+        if budget <= 0 or (mime_type == "text/html" and found["text/plain"]):
+            continue
+        body = part.get('body') or {}
+        data = body.get('data')
+        if data is None and body.get('attachmentId') and fetch_attachment is not None:
+            data = fetch_attachment(body['attachmentId'])
+        if not data:
+            continue
+        charset = CHARSET_RE.search(_part_header(part, 'Content-Type'))
+        try:
+            text, used, cut = _decode_part_data(data, charset.group(1) if charset else "utf-8", budget)
+        except (ValueError, LookupError) as e: # bad base64 (binascii.Error) or a non-text codec
+            print(f"Parsing error: {e}")
+            continue
+        truncated = truncated or cut
+        budget -= used
+        if text.strip():
+            found[mime_type].append(text)
+
+    if found["text/plain"]:
+        return {"text": "\n\n".join(t.strip() for t in found["text/plain"]), "source": "plain", "truncated": truncated}
+    if found["text/html"]:
+        text = "\n\n".join(html_to_text(markup) for markup in found["text/html"])
+        return {"text": text, "source": "html" if text else None, "truncated": truncated}
+    return {"text": "", "source": None, "truncated": truncated}
+
+def get_email_body(msg, fetch_attachment=None):
+    """
+    Extracts the cleanest body text from a (possibly nested) multi-part Gmail
+    message. Empty when there is none. Attachment fetch errors are raised.
+    """
+    with metrics.time("mime_extract"):
+        body = extract_body(msg, fetch_attachment)
+    if body['truncated']:
+        metrics.inc("mail_truncated_bodies_total")
+    return body['text']
+
+# --- EMBEDDING STORE (ONE VECTOR PER EMAIL, REUSED ACROSS STAGES) ---
+class EmbeddingStore:
+    """
+    Local append-only store of email embeddings keyed by email id. Vectors live
+    as float16 rows in `vectors.f16` (memory-mapped for reads) with a parallel
+    `ids.i64` file; re-analyzing an email appends a new row that shadows the old
+    one. Similarity search, clustering and re-classification read vectors from
+    here instead of re-encoding the corpus. The server and a reclassify job may
+    share the directory: every operation holds a file lock and first picks up
+    rows appended (or a compaction done) by the other process.
+    """
+
+    def __init__(self, directory: str, dim: int = EMBEDDING_DIM):
+        self.directory = directory
+        self.dim = dim
+        self.row_bytes = dim * np.dtype(np.float16).itemsize
+        self.vectors_path = os.path.join(directory, "vectors.f16")
+        self.ids_path = os.path.join(directory, "ids.i64")
+        self.lock_path = os.path.join(directory, "store.lock")
+        self._lock = threading.Lock()
+        self._rows = {}   # email_id -> latest row
+        self._total = 0   # rows on disk, including shadowed ones
+        self._ids_inode = None # changes when a compaction (ours or another process's) replaces the files
+        self._mmap = None
+        os.makedirs(directory, exist_ok=True)
+        with self._locked(exclusive=True):
+            if self._needs_compaction():
+                self._compact()
+
+    @contextmanager
+    def _locked(self, exclusive: bool = False):
+        """Thread lock plus an advisory file lock, then catches up with changes made by other processes."""
+        with self._lock:
+            if fcntl is None:
+                self._sync(exclusive)
+                yield
+                return
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    self._sync(exclusive)
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _sync(self, exclusive: bool):
+        if not os.path.exists(self.ids_path) or not os.path.exists(self.vectors_path):
+            self._load(exclusive)
+            return
+        stat = os.stat(self.ids_path)
+        if stat.st_ino != self._ids_inode or stat.st_size < self._total * 8:
+            self._load(exclusive)
+            return
+        total = min(stat.st_size // 8, os.path.getsize(self.vectors_path) // self.row_bytes)
+        if total > self._total:
+            # Another process appended rows: index just the new tail
+            with open(self.ids_path, "rb") as f:
+                f.seek(self._total * 8)
+                appended = np.frombuffer(f.read((total - self._total) * 8), dtype=np.int64)
+            for offset, email_id in enumerate(appended):
+                self._rows[int(email_id)] = self._total + offset
+            self._total = total
+
+    def _load(self, repair: bool):
+        for path in (self.vectors_path, self.ids_path):
+            if not os.path.exists(path):
+                open(path, "ab").close()
+        ids = np.fromfile(self.ids_path, dtype=np.int64)
+        # A crash between the two appends leaves one file longer; keep the rows both agree on
+        total = min(len(ids), os.path.getsize(self.vectors_path) // self.row_bytes)
+        if repair and (total < len(ids) or total * self.row_bytes < os.path.getsize(self.vectors_path)):
+            with open(self.ids_path, "r+b") as f:
+                f.truncate(total * ids.itemsize)
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(total * self.row_bytes)
+        self._rows = {int(email_id): row for row, email_id in enumerate(ids[:total])}
+        self._total = total
+        self._ids_inode = os.stat(self.ids_path).st_ino
+        self._mmap = None
+
+    def _needs_compaction(self):
+        return self._total > 2 * len(self._rows) + 1024
+
+    def _compact(self):
+        """Rewrites both files with only the latest row per email."""
+        ids = list(self._rows)
+        vectors = self._matrix()[[self._rows[email_id] for email_id in ids]] if ids else np.zeros((0, self.dim), np.float16)
+        self._mmap = None # fancy indexing copied the rows; release the old file before replacing it
+        for path, data in ((self.vectors_path, vectors), (self.ids_path, np.asarray(ids, dtype=np.int64))):
+            tmp_path = f"{path}.tmp"
+            data.tofile(tmp_path)
+            os.replace(tmp_path, path)
+        self._rows = {email_id: row for row, email_id in enumerate(ids)}
+        self._total = len(ids)
+        self._ids_inode = os.stat(self.ids_path).st_ino
+
+    def _matrix(self):
+        """Memory-mapped view of every row on disk, remapped after appends."""
+        if self._total == 0:
+            return np.zeros((0, self.dim), dtype=np.float16)
+        if self._mmap is None or len(self._mmap) < self._total:
+            self._mmap = np.memmap(self.vectors_path, dtype=np.float16, mode="r", shape=(self._total, self.dim))
+        return self._mmap
+
+    def __len__(self):
+        with self._locked():
+            return len(self._rows)
+
+    def __contains__(self, email_id):
+        if email_id is None:
+            return False
+        with self._locked():
+            return int(email_id) in self._rows
+
+    def put_many(self, email_ids, vecs):
+        """Appends (email_id, vector) pairs; later calls win for the same email."""
+        pairs = [(int(email_id), vec) for email_id, vec in zip(email_ids, vecs) if email_id is not None and vec is not None]
+        if not pairs:
+            return
+        ids = np.asarray([email_id for email_id, _ in pairs], dtype=np.int64)
+        vectors = np.asarray([vec for _, vec in pairs], dtype=np.float16).reshape(len(pairs), self.dim)
+        with self._locked(exclusive=True):
+            with open(self.vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            with open(self.ids_path, "ab") as f:
+                f.write(ids.tobytes())
+            for offset, email_id in enumerate(ids):
+                self._rows[int(email_id)] = self._total + offset
+            self._total += len(pairs)
+            # A long-running server re-analyzes emails, so shadowed rows pile up between restarts
+            if self._needs_compaction():
+                self._compact()
+
+    def put(self, email_id, vec):
+        self.put_many([email_id], [vec])
+
+    def get_many(self, email_ids):
+        """Returns a float32 vector (or None when unknown) for every id."""
+        with self._locked():
+            rows = [self._rows.get(int(email_id)) if email_id is not None else None for email_id in email_ids]
+            known = [i for i, row in enumerate(rows) if row is not None]
+            vecs = [None] * len(rows)
+            if known:
+                block = np.asarray(self._matrix()[[rows[i] for i in known]], dtype=np.float32)
+                for i, vec in zip(known, block):
+                    vecs[i] = vec
+        return vecs
+
+    def get(self, email_id):
+        return self.get_many([email_id])[0]
+
+    def matrix(self, email_ids=None):
+        """
+        Returns (ids, float32 matrix) for the given emails, or for every stored
+        email, so callers can cluster or re-run classifier heads in one call.
+        Unknown ids are left out.
+        """
+        with self._locked():
+            ids = list(self._rows) if email_ids is None else [int(e) for e in email_ids if e is not None and int(e) in self._rows]
+            if not ids:
+                return [], np.zeros((0, self.dim), dtype=np.float32)
+            return ids, np.asarray(self._matrix()[[self._rows[email_id] for email_id in ids]], dtype=np.float32)
+
+    def stats(self):
+        with self._locked():
             return {
-                "resolution": issue['final_resolution_details'],
-                "resolved_at": issue['resolved_at'],
-                "intent": issue['extracted_entities']['intent']
+                "emails": len(self._rows),
+                "rows_on_disk": self._total,
+                "bytes_on_disk": self._total * self.row_bytes,
+                "dtype": "float16",
+                "dim": self.dim,
+                "directory": self.directory
             }
-        
-        return None
-        
-    except Exception as e:
-        print(f"❌ Vector Search Error: {e}")
-        return None
-        
-# --- FULL ANALYSIS PIPELINE ---
-def run_analysis_pipeline(text: str, received_at_dt: datetime):
-    
-    # --- 1. Metadata ---
-    age_hours = (datetime.now() - received_at_dt).total_seconds() / 3600
 
-    # --- 2. Classification & Summarization (Model Inference) ---
-    results = {
-        "detected_intent": "unknown", "detected_sentiment": "neutral", "predicted_priority": "low",
-        "summary": "Processing...", "compliance_alerts": []
+# --- VECTOR SEARCH FOR CACHING (NEW) ---
+class ResolvedEmailIndex:
+    """
+    In-process cosine-similarity index over resolved emails. Vectors are stored
+    L2-normalized in a NumPy matrix so a search is a single matrix product.
+    With RESOLVED_INDEX_BACKEND=faiss (and faiss installed) large corpora use an
+    approximate HNSW index instead of the exact scan. New rows are added to it
+    incrementally; it is (re)built on a background thread, during which
+    searches use the exact scan.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM, backend: str = "numpy"):
+        self.dim = dim
+        self.backend = backend if backend == "numpy" or faiss is not None else "numpy"
+        self._lock = threading.Lock()
+        self._matrix = np.zeros((64, dim), dtype=np.float32)
+        self._size = 0
+        self._rows = {}   # email_id -> row
+        self._meta = []   # row -> resolution details
+        self._ann = None
+        self._ann_building = False
+        self._replaced = 0 # bumped when an existing row changes; HNSW cannot update a row in place
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _normalize(vecs):
+        vecs = np.atleast_2d(np.asarray(vecs, dtype=np.float32))
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vecs / norms
+
+    def add_many(self, email_ids, vecs, metas):
+        """Adds or replaces resolved emails. Growth is amortized by doubling the backing matrix."""
+        if len(email_ids) == 0:
+            return
+        vecs = self._normalize(vecs)
+        with self._lock:
+            first_new = self._size
+            replaced = False
+            for email_id, vec, meta in zip(email_ids, vecs, metas):
+                row = self._rows.get(email_id)
+                if row is None:
+                    if self._size == len(self._matrix):
+                        grown = np.zeros((len(self._matrix) * 2, self.dim), dtype=np.float32)
+                        grown[:self._size] = self._matrix[:self._size]
+                        self._matrix = grown
+                    row = self._size
+                    self._rows[email_id] = row
+                    self._meta.append(meta)
+                    self._size += 1
+                else:
+                    self._meta[row] = meta
+                    replaced = True
+                self._matrix[row] = vec
+            if replaced:
+                self._replaced += 1
+                self._ann = None
+            elif self._ann is not None and self._size > first_new:
+                # HNSW ids are assigned in insertion order, so they stay equal to our row numbers
+                self._ann.add(self._matrix[first_new:self._size])
+            if self._ann is None and self.backend == "faiss" and self._size >= RESOLVED_INDEX_ANN_MIN_SIZE and not self._ann_building:
+                self._ann_building = True
+                threading.Thread(target=self._build_ann, name="resolved-index-ann", daemon=True).start()
+
+    def add(self, email_id, vec, meta):
+        self.add_many([email_id], [vec], [meta])
+
+    def _build_ann(self):
+        """Builds the HNSW graph from a snapshot without holding the lock, then catches up and publishes it."""
+        while True:
+            with self._lock:
+                snapshot = self._matrix[:self._size].copy()
+                replaced = self._replaced
+            ann = faiss.IndexHNSWFlat(self.dim, 32, faiss.METRIC_INNER_PRODUCT)
+            ann.add(snapshot)
+            with self._lock:
+                if self._replaced != replaced:
+                    continue # a row changed mid-build; start over from a fresh snapshot
+                if self._size > len(snapshot):
+                    ann.add(self._matrix[len(snapshot):self._size])
+                self._ann = ann
+                self._ann_building = False
+                return
+
+    def _candidates(self, queries, k, intent):
+        if self._ann is not None:
+            # Over-fetch when filtering by intent so filtered-out neighbours don't starve the result
+            fetch = min(self._size, k * 10 if intent else k)
+            return self._ann.search(queries, fetch)
+        scores = queries @ self._matrix[:self._size].T
+        if intent:
+            mask = np.fromiter((meta.get('intent') == intent for meta in self._meta), dtype=bool, count=self._size)
+            scores[:, ~mask] = -np.inf
+        k = min(k, self._size)
+        rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        row_scores = np.take_along_axis(scores, rows, axis=1)
+        order = np.argsort(-row_scores, axis=1)
+        return np.take_along_axis(row_scores, order, axis=1), np.take_along_axis(rows, order, axis=1)
+
+    def search(self, query_vecs, k: int = 1, intent: str = None, min_score: float = 0.0):
+        """Returns, for every query vector, up to k (meta, score) pairs ordered by cosine similarity."""
+        queries = self._normalize(query_vecs)
+        with self._lock:
+            if self._size == 0:
+                return [[] for _ in range(len(queries))]
+            scores, rows = self._candidates(queries, k, intent)
+            results = []
+            for q_scores, q_rows in zip(scores, rows):
+                hits = []
+                for score, row in zip(q_scores, q_rows):
+                    if row < 0 or score < min_score:
+                        continue
+                    meta = self._meta[row]
+                    if intent and meta.get('intent') != intent:
+                        continue
+                    hits.append((meta, float(score)))
+                    if len(hits) == k:
+                        break
+                results.append(hits)
+            return results
+
+def _resolution_meta(row):
+    return {
+        "resolution": row['final_resolution_details'],
+        "resolved_at": row['resolved_at'],
+        "intent": (row.get('extracted_entities') or {}).get('intent')
     }
-    
-    if 'm_intent' in ai_resources:
+
+def lookup_email_vectors(email_ids, texts):
+    """
+    Returns one embedding per email, reusing vectors from the embedding store or
+    the analysis cache, and encoding only what is left in one call. Newly found
+    vectors are written back to the embedding store.
+    """
+    store = ai_resources.get('embedding_store')
+    vecs = store.get_many(email_ids) if store is not None else [None] * len(email_ids)
+    stored = [vec is not None for vec in vecs]
+    missing = [i for i, vec in enumerate(vecs) if vec is None]
+
+    cache = ai_resources.get('analysis_cache')
+    if missing and cache is not None:
         try:
-            # Classification logic 
-            embedder = ai_resources['embedder']
-            vec = embedder.encode([text])
-            hybrid_vec = np.column_stack((vec, [[age_hours]]))
-            
-            pred_intent = ai_resources['m_intent'].predict(vec)[0]
-            pred_sentiment = ai_resources['m_sentiment'].predict(vec)[0]
-            pred_priority = ai_resources['m_priority'].predict(hybrid_vec)[0]
-
-            # FIX: Force lowercase and strip whitespace for PostgreSQL ENUM compatibility
-            results['detected_intent'] = ai_resources['le_intent'].inverse_transform([pred_intent])[0].lower().strip()
-            results['detected_sentiment'] = ai_resources['le_sentiment'].inverse_transform([pred_sentiment])[0].lower().strip()
-            results['predicted_priority'] = ai_resources['le_priority'].inverse_transform([pred_priority])[0].lower().strip()
+            version = current_model_version()
+            keys = {i: AnalysisCache.make_key(texts[i], version) for i in missing}
+            cached = cache.get_many(list(keys.values()))
+            for i, key in keys.items():
+                if key in cached and cached[key][1] is not None:
+                    vecs[i] = cached[key][1]
         except Exception as e:
-            print(f"Classification Error: {e}")
+            print(f"Analysis Cache Read Error: {e}")
+        missing = [i for i, vec in enumerate(vecs) if vec is None]
+
+    if missing and 'embedder' in ai_resources:
+        encoded = ai_resources['embedder'].encode([texts[i] for i in missing])
+        for i, vec in zip(missing, encoded):
+            vecs[i] = vec
+
+    if store is not None:
+        fresh = [i for i, vec in enumerate(vecs) if vec is not None and not stored[i] and email_ids[i] is not None]
+        if fresh:
+            try:
+                store.put_many([email_ids[i] for i in fresh], [vecs[i] for i in fresh])
+            except Exception as e:
+                print(f"Embedding Store Write Error: {e}")
+    return vecs
 
-    # --- 3. Summarization (FIXED BLOCK: Added length check for stability) ---
-    if 'summarizer' in ai_resources:
+def build_resolved_index():
+    """Loads every resolved email into a fresh ResolvedEmailIndex."""
+    db = ai_resources['db']
+    index = ResolvedEmailIndex(backend=RESOLVED_INDEX_BACKEND)
+    page_size = 1000
+    start = 0
+    while True:
+        response = db.table('email_analysis').select(
+            'email_id, final_resolution_details, resolved_at, extracted_entities, emails(body_content)'
+        ).not_.is_('final_resolution_details', 'NULL').order('email_id').range(start, start + page_size - 1).execute()
+        rows = response.data or []
+        if rows:
+            texts = [(row.get('emails') or {}).get('body_content') or "" for row in rows]
+            vecs = lookup_email_vectors([row['email_id'] for row in rows], texts)
+            index.add_many([row['email_id'] for row in rows], vecs, [_resolution_meta(row) for row in rows])
+        if len(rows) < page_size:
+            break
+        start += page_size
+    return index
+
+def _resolutions_by_intent(intents):
+    """
+    Returns {intent: resolution meta or None} from the intent-to-resolution map,
+    querying only intents not seen before (one query per distinct intent).
+    """
+    resolution_map = ai_resources.setdefault('resolution_by_intent', {})
+    db = ai_resources.get('db')
+    for intent in intents:
+        if intent in resolution_map or db is None:
+            continue
         try:
-            tokenizer = ai_resources['tokenizer']
-            model = ai_resources['summarizer']
-            device = ai_resources['device']
+            response = db.table('email_analysis').select(
+                'final_resolution_details, resolved_at, extracted_entities'
+            ).eq('extracted_entities->>intent', intent).not_.is_('final_resolution_details', 'NULL').limit(1).execute()
+            resolution_map[intent] = _resolution_meta(response.data[0]) if response.data else None
+        except Exception as e:
+            print(f"❌ Resolution Lookup Error: {e}")
+    return {intent: resolution_map.get(intent) for intent in intents}
 
-            # Use a short version of the text for summarization to avoid crashing the model 
-            short_text = text[:8000] 
+def suggest_resolutions(email_ids, texts, intents, vecs=None):
+    """
+    Bulk version of find_similar_resolved_emails: one embedding lookup for all
+    emails and one index search per distinct intent. Returns a list aligned with
+    the inputs holding a resolution dict or None. Precomputed `vecs` (None where
+    unknown) skip the lookup.
+    """
+    suggestions = [None] * len(texts)
+    wanted = [i for i, intent in enumerate(intents) if intent and intent != 'unknown']
+    if not wanted:
+        return suggestions
 
-            inputs = tokenizer(short_text, return_tensors="pt", truncation=True, max_length=1024).to(device)
-            
-            with torch.no_grad():
-                summary_ids = model.generate(
-                    inputs["input_ids"], 
-                    max_length=100, 
-                    min_length=30, 
-                    num_beams=4, 
-                    early_stopping=True
-                )
-            
-            summary = tokenizer.decode(summary_ids[0], skip_special_tokens=True)
-            
-            # Final Safety Check: If the summary is still blank, provide a fallback
-            if not summary or len(summary.strip()) < 5:
-                 results['summary'] = "Model produced a blank summary. (AI Error Fallback)"
-            else:
-                 results['summary'] = summary
-                 
+    index = ai_resources.get('resolved_index')
+    if index is not None:
+        try:
+            known = vecs or [None] * len(texts)
+            # Rows listed without their body can only use vectors that already exist
+            store = ai_resources.get('embedding_store')
+            todo = [i for i in wanted if known[i] is None and (texts[i] or (store is not None and email_ids[i] in store))]
+            looked_up = dict(zip(todo, lookup_email_vectors([email_ids[i] for i in todo], [texts[i] or "" for i in todo]))) if todo else {}
+            by_intent = {}
+            for i in wanted:
+                vec = known[i] if known[i] is not None else looked_up.get(i)
+                if vec is not None:
+                    by_intent.setdefault(intents[i], []).append((i, vec))
+            for intent, items in by_intent.items():
+                matches = index.search([vec for _, vec in items], k=1, intent=intent, min_score=RESOLVED_MIN_SIMILARITY)
+                for (i, _), hits in zip(items, matches):
+                    if hits:
+                        meta, score = hits[0]
+                        suggestions[i] = {**meta, "similarity": round(score, 4)}
         except Exception as e:
-            print(f"Summarizer Runtime Error: {e}")
-            results['summary'] = "Summary generation failed due to complex/long input."
+            print(f"❌ Vector Search Error: {e}")
+        return suggestions
 
-    # --- 4. Agent Assist Logic ---
-    intent = results['detected_intent'].lower()
-    sentiment = results['detected_sentiment'].lower()
-    priority = results['predicted_priority'].lower()
-    
-    rec_action = "Standard Reply"
-    why = "Routine inquiry."
-    
-    if sentiment == 'angry' or priority == 'high':
-        rec_action = "Escalate to Senior Agent"
-        why = "🔥 High risk detected. Requires experienced handling."
-    elif 'refund' in intent:
-        rec_action = "Route to Finance_Dept"
-        why = "Customer is requesting a refund."
-    elif 'login' in intent or 'tech' in intent or 'account' in intent:
-        rec_action = "Route to Tech_Support"
-        why = "Technical issue identified."
+    # Fallback while the index is unavailable: any resolution with the same intent
+    resolutions = _resolutions_by_intent({intents[i] for i in wanted})
+    for i in wanted:
+        suggestions[i] = resolutions.get(intents[i])
+    return suggestions
 
-    # Compliance Check
-    bad_words = ["sue", "lawyer", "scam", "cheat"]
-    if any(w in text.lower() for w in bad_words):
-        results['compliance_alerts'].append("Legal Threat")
+def find_similar_resolved_emails(current_email_text: str, current_intent: str, current_vec=None):
+    """Finds the most similar previously resolved email with matching intent."""
+    return suggest_resolutions([None], [current_email_text], [current_intent], vecs=[current_vec])[0]
 
-    return {
-        "email_metadata": {
-            "received_at": str(received_at_dt),
-            "age_hours": f"{age_hours:.1f}"
-        },
-        "ai_insights": results,
-        "agent_assist": {
-            "recommended_action": rec_action,
-            "why?": why,
-            "compliance_alerts": results['compliance_alerts']
-        }
+def index_resolved_email(email_id: int, analysis_row: dict, resolution_text: str, resolved_at: str):
+    """Records a fresh resolution in the intent map and adds it to the index without rebuilding it."""
+    meta = {
+        "resolution": resolution_text,
+        "resolved_at": resolved_at,
+        "intent": (analysis_row.get('extracted_entities') or {}).get('intent')
     }
+    if meta['intent']:
+        ai_resources.setdefault('resolution_by_intent', {})[meta['intent']] = meta
 
-
-# --- THE GMAIL SYNC FUNCTION ---
-def sync_and_analyze_emails():
-    """Background task to pull recent emails, analyze them, and save to DB."""
-    service = get_gmail_service()
+    index = ai_resources.get('resolved_index')
     db = ai_resources.get('db')
-    if service is None or db is None:
-        print("Sync Failed: Service/DB not available.")
+    if index is None or db is None:
         return
-
     try:
-        # --- GMAIL QUERY FIX: Search for ALL messages received in the last 3 days ---
-        three_days_ago = int((datetime.now() - timedelta(days=3)).timestamp())
-        
-        results = service.users().messages().list(
-            userId='me', 
-            q=f"after:{three_days_ago}", # Broadened search query
-            maxResults=10 # Increased max results slightly
-        ).execute()
-        messages = results.get('messages', [])
+        store = ai_resources.get('embedding_store')
+        vec = store.get(email_id) if store is not None else None
+        if vec is None:
+            email_res = db.table("emails").select("body_content").eq("id", email_id).execute()
+            if not email_res.data:
+                return
+            vec = lookup_email_vectors([email_id], [email_res.data[0]['body_content'] or ""])[0]
+        if vec is not None:
+            index.add(email_id, vec, meta)
+    except Exception as e:
+        print(f"❌ Resolved Index Update Error: {e}")
 
-        if not messages:
-            print("No new emails found in the last 3 days.")
-            return
+# --- EMAIL TEXT CLEANUP (BEFORE SUMMARIZATION) ---
+# Lines where the quoted history of a reply starts
+REPLY_HEADER_RE = re.compile(
+    r"^[ \t]*(On\b[^\n]*\n?[^\n]*?\bwrote:"             # Gmail / Apple Mail, possibly wrapped onto a second line
+    r"|-{2,}[ \t]*Original Message[ \t]*-{2,}"          # Outlook
+    r"|-{2,}[ \t]*Forwarded message[ \t]*-{2,}"
+    r"|From:[ \t][^\n]+\n[ \t]*(?:Sent|Date):[ \t])",    # Outlook header block: From: and Sent:/Date: on consecutive lines
+    re.IGNORECASE | re.MULTILINE
+)
+SIGNATURE_RE = re.compile(r"^(--\s*|_{5,}|Sent from my \w+.*|Get Outlook for \w+.*)$", re.IGNORECASE | re.MULTILINE)
+SIGNOFF_RE = re.compile(r"^(thanks|thank you|many thanks|regards|best|best regards|kind regards|warm regards|cheers|sincerely)[,.!]?$", re.IGNORECASE)
+SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
 
-        print(f"Found {len(messages)} recent emails. Starting AI processing...")
-        
-        for msg_data in messages:
-            msg_id = msg_data['id']
-            
-            # 1. Deduplication Check (CRITICAL)
-            supabase_check = db.table("emails").select("id").eq("conversation_thread_id", msg_id).execute()
-            if supabase_check.data:
+def clean_email_text(text: str) -> str:
+    """
+    Keeps only the new content of an email: drops HTML remnants, the quoted
+    reply history, '>' quoted lines and the signature. Falls back to the
+    original text when nothing would be left.
+    """
+    if not text:
+        return ""
+    cleaned = text
+    if "<" in cleaned and HTML_TAG_RE.search(cleaned):
+        cleaned = strip_html_tags(cleaned)
+    cleaned = html.unescape(cleaned).replace("\r\n", "\n").replace("\xa0", " ")
+
+    reply = REPLY_HEADER_RE.search(cleaned)
+    if reply:
+        cleaned = cleaned[:reply.start()]
+    signature = SIGNATURE_RE.search(cleaned)
+    if signature:
+        cleaned = cleaned[:signature.start()]
+
+    lines = [line.strip() for line in cleaned.split("\n") if not line.lstrip().startswith(">")]
+    # A sign-off near the end ("Thanks,\nAlex") starts the signature block
+    tail = [i for i, line in enumerate(lines) if line.strip()][-4:]
+    for i in tail:
+        if SIGNOFF_RE.match(lines[i]):
+            lines = lines[:i]
+            break
+    cleaned = re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+    cleaned = re.sub(r"[ \t]+", " ", cleaned).strip()
+    return cleaned or text.strip()
+
+# --- SUMMARIZER BACKENDS ---
+class SummarizerBackend:
+    """
+    A seq2seq summarizer behind a single generate(texts) call. Subclasses only
+    differ in how the model is loaded; tokenization and decoding are shared.
+    """
+
+    name = "torch"
+
+    def __init__(self, model_name: str = None, num_beams: int = None, device: str = None):
+        self.model_name = model_name or SUMMARIZER_MODEL_NAME
+        self.num_beams = max(1, num_beams or SUMMARIZER_NUM_BEAMS)
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        self.model = self._load_model()
+
+    def _load_model(self):
+        model = AutoModelForSeq2SeqLM.from_pretrained(self.model_name).to(self.device)
+        model.eval()
+        return model
+
+    def describe(self) -> str:
+        return f"{self.name}:{self.model_name}:beams={self.num_beams}"
+
+    def generate(self, texts):
+        """Runs one padded decoding call over a list of texts and returns the decoded summaries."""
+        # Use a short version of the text for summarization to avoid crashing the model
+        short_texts = [text[:8000] for text in texts]
+
+        inputs = self.tokenizer(short_texts, return_tensors="pt", truncation=True, max_length=1024, padding=True).to(self.device)
+
+        with torch.no_grad():
+            summary_ids = self.model.generate(
+                inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                max_length=100,
+                min_length=30,
+                num_beams=self.num_beams,
+                early_stopping=self.num_beams > 1
+            )
+
+        return self.tokenizer.batch_decode(summary_ids, skip_special_tokens=True)
+
+    def _generate_sorted(self, texts, batch_size):
+        """generate() over any number of texts, batching similar lengths together; keeps input order."""
+        outputs = [None] * len(texts)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for start in range(0, len(order), batch_size):
+            idxs = order[start:start + batch_size]
+            for i, summary in zip(idxs, self.generate([texts[i] for i in idxs])):
+                outputs[i] = summary
+        return outputs
+
+    def _chunk(self, text, budget):
+        """Splits text at sentence boundaries into pieces of at most `budget` tokens."""
+        sentences = [sentence.strip() for sentence in SENTENCE_SPLIT_RE.split(text) if sentence and sentence.strip()]
+        token_ids = self.tokenizer(sentences, add_special_tokens=False)["input_ids"] if sentences else []
+        chunks, current, size = [], [], 0
+        for sentence, ids in zip(sentences, token_ids):
+            if current and size + len(ids) > budget:
+                chunks.append(" ".join(current))
+                current, size = [], 0
+            if len(ids) > budget:
+                # A run-on "sentence" (pasted logs, no punctuation) is cut by tokens
+                chunks.extend(self.tokenizer.decode(ids[i:i + budget]) for i in range(0, len(ids), budget))
                 continue
+            current.append(sentence)
+            size += len(ids)
+        if current:
+            chunks.append(" ".join(current))
+        return chunks or [text]
 
-            # 2. Get full message content
-            message = service.users().messages().get(userId='me', id=msg_id).execute()
-            
-            # Extract headers and body
-            headers = {h['name']: h['value'] for h in message['payload']['headers']}
-            sender = headers.get('From', 'Unknown Sender')
-            subject = headers.get('Subject', 'No Subject')
-            received_timestamp = float(message['internalDate']) / 1000.0 # Convert milliseconds to seconds
-            received_dt = datetime.fromtimestamp(received_timestamp)
-            
-            body_content = get_email_body(message)
-            
-            # 3. Run AI Analysis
-            analysis_result = run_analysis_pipeline(body_content, received_dt)
-            
-            # 4. Save to Database
-            insights = analysis_result['ai_insights']
-            assist = analysis_result['agent_assist']
-            
-            email_res = db.table("emails").insert({
-                "sender_email": sender,
-                "subject_line": subject,
-                "body_content": body_content,
-                "is_read": False,
-                "received_at": received_dt.isoformat(),
-                "conversation_thread_id": msg_id 
-            }).execute()
-            
-            new_id = email_res.data[0]['id']
-            
-            db.table("email_analysis").insert({
-                "email_id": new_id,
-                "summary_text": insights['summary'],
-                "sentiment": insights['detected_sentiment'],
-                "urgency_score": insights['predicted_priority'],
-                "compliance_flag": len(assist['compliance_alerts']) > 0,
-                "compliance_reason": ", ".join(assist['compliance_alerts']),
-                "recommended_action": assist['recommended_action'],
-                "action_reason": assist['why?'], # Fixed column name
-                "extracted_entities": {"intent": insights['detected_intent']}
-            }).execute()
-            
-        print("✅ GMail Sync Complete!")
-        
-    except HttpError as error:
-        print(f"❌ GMail API Error: {error}")
-        print("Hint: Check if the GMAIL_TOKEN_FILE exists and is valid.")
-    except Exception as e:
-        print(f"❌ Sync Error: {e}")
+    def summarize(self, texts, batch_size: int = None):
+        """
+        Token-aware summarization. Each email is cleaned first; emails that fit in
+        SUMMARY_CHUNK_TOKENS are summarized directly, longer ones are split into
+        token-bounded chunks whose summaries are merged and summarized again
+        (map-reduce). Every round runs all pending pieces through shared batches;
+        after SUMMARY_MAX_REDUCE_ROUNDS reduce rounds the merged partials are
+        summarized in one truncated pass.
+        """
+        if SUMMARY_STRATEGY != "chunked":
+            return self.generate(texts)
+        batch_size = max(1, batch_size or SUMMARY_BATCH_SIZE)
+        budget = max(SUMMARY_MIN_CHUNK_TOKENS, SUMMARY_CHUNK_TOKENS) - 2 # room for <s> and </s>
 
+        cleaned = [clean_email_text(text) for text in texts]
+        lengths = [len(ids) for ids in self.tokenizer(cleaned, add_special_tokens=False)["input_ids"]]
+        # Tokenizing the raw body (quoted history and all) just for a metric is the cost cleanup avoids; scale instead
+        raw_tokens = sum(
+            round(length * len(text) / len(clean)) if clean else len(text) // 4
+            for text, clean, length in zip(texts, cleaned, lengths)
+        )
+        metrics.inc("mail_summary_tokens_total", raw_tokens, stage="raw")
+        metrics.inc("mail_summary_tokens_total", sum(lengths), stage="clean")
 
-# --- API ENDPOINTS ---
+        pending = {}
+        for i, (text, length) in enumerate(zip(cleaned, lengths)):
+            pending[i] = [text] if length <= budget else self._chunk(text, budget)[:SUMMARY_MAX_CHUNKS]
+        summaries = [None] * len(texts)
+        kind = None
+        rounds = 0
+        while pending:
+            for chunks in pending.values():
+                label = kind or ("direct" if len(chunks) == 1 else "chunk")
+                metrics.inc("mail_summary_inputs_total", len(chunks), kind=label)
+            flat = [chunk for chunks in pending.values() for chunk in chunks]
+            outputs = iter(self._generate_sorted(flat, batch_size))
+            reduce_next = {}
+            for i, chunks in pending.items():
+                partials = [next(outputs) for _ in chunks]
+                if len(partials) == 1:
+                    summaries[i] = partials[0]
+                    continue
+                merged = " ".join(partial.strip() for partial in partials if partial and partial.strip())
+                if not merged or rounds >= SUMMARY_MAX_REDUCE_ROUNDS:
+                    # generate() truncates to the model's input limit
+                    reduce_next[i] = [merged]
+                else:
+                    # Partial summaries are far shorter than their chunks, so every round shrinks the input
+                    reduce_next[i] = self._chunk(merged, budget)
+            pending, kind = reduce_next, "reduce"
+            rounds += 1
+        return summaries
 
-@app.post("/sync-gmail")
-async def sync_gmail_endpoint(background_tasks: BackgroundTasks):
+class QuantizedSummarizer(SummarizerBackend):
+    """Dynamic int8 quantization of every Linear layer. CPU only."""
+
+    name = "torch-int8"
+
+    def __init__(self, model_name: str = None, num_beams: int = None, device: str = None):
+        super().__init__(model_name, num_beams, device="cpu")
+
+    def _load_model(self):
+        model = AutoModelForSeq2SeqLM.from_pretrained(self.model_name)
+        model.eval()
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+class OnnxSummarizer(SummarizerBackend):
     """
-    Triggers the GMail sync and AI processing as a background task.
+    Runs the model with ONNX Runtime (needs `optimum[onnxruntime]`). The export
+    happens once and is saved under MODEL_CACHE_DIR/onnx; later loads reuse it.
     """
-    background_tasks.add_task(sync_and_analyze_emails)
-    return {"message": "Sync started in background. Check dashboard in a moment."}
 
-@app.get("/emails")
-def get_emails(filter_priority: str = None, filter_sentiment: str = None):
-    # --- New Feature: Retrieval Augmentation/Caching ---
-    db = ai_resources.get('db')
-    
-    # 1. Fetch ALL emails and analyses
-    query = db.table("emails").select("*, email_analysis(*)")
-    response = query.order("received_at", desc=True).execute()
-    
-    formatted_emails = []
-    
-    for email in response.data:
-        analysis_data = email.get("email_analysis")
-        analysis = analysis_data[0] if isinstance(analysis_data, list) and analysis_data else (analysis_data if analysis_data else {})
-        
-        # Add the suggested resolution details if found
-        if analysis.get('resolved_at') is None: # Only search cache for UNRESOLVED emails
-            # 1. Get the current email's detected intent (from its own analysis)
-            current_intent = analysis.get('extracted_entities', {}).get('intent')
-            
-            # 2. Run the cache search using the current intent as the key
-            suggested_resolution = find_similar_resolved_emails(email['body_content'], current_intent)
-            
-            if suggested_resolution:
-                 analysis['suggested_resolution'] = suggested_resolution
-        
-        if filter_priority and analysis.get("urgency_score") != filter_priority: continue
-        if filter_sentiment and analysis.get("sentiment") != filter_sentiment: continue
-        
-        formatted_emails.append({**email, "analysis": analysis})
-        
-    return formatted_emails
+    name = "onnx"
 
-@app.post("/escalate/{email_id}")
+    def __init__(self, model_name: str = None, num_beams: int = None, device: str = None):
+        super().__init__(model_name, num_beams, device="cpu")
+
+    def _load_model(self):
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+        export_dir = os.path.join(MODEL_CACHE_DIR, "onnx", self.model_name.replace("/", "--"))
+        if os.path.isdir(export_dir):
+            return ORTModelForSeq2SeqLM.from_pretrained(export_dir)
+        model = ORTModelForSeq2SeqLM.from_pretrained(self.model_name, export=True)
+        partial_dir = f"{export_dir}.partial"
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        model.save_pretrained(partial_dir) # renamed into place so a killed export is never picked up
+        os.replace(partial_dir, export_dir)
+        return model
+
+SUMMARIZER_BACKENDS = {
+    SummarizerBackend.name: SummarizerBackend,
+    QuantizedSummarizer.name: QuantizedSummarizer,
+    OnnxSummarizer.name: OnnxSummarizer,
+}
+
+def create_summarizer(backend: str = None, model_name: str = None, num_beams: int = None) -> SummarizerBackend:
+    """Builds the configured summarizer. model_name may be a SUMMARIZER_PRESETS key or any Hub model id."""
+    backend = backend or SUMMARIZER_BACKEND
+    if backend not in SUMMARIZER_BACKENDS:
+        raise ValueError(f"Unknown summarizer backend '{backend}'. Choose from: {', '.join(SUMMARIZER_BACKENDS)}")
+    model_name = SUMMARIZER_PRESETS.get(model_name, model_name)
+    return SUMMARIZER_BACKENDS[backend](model_name, num_beams)
+
+# --- MODEL REGISTRY (VERSIONED CLASSIFIER SETS + HOT-SWAP) ---
+CLASSIFIER_FILES = {
+    "m_intent": "model_intent.pkl",
+    "m_sentiment": "model_sentiment.pkl",
+    "m_priority": "model_priority.pkl",
+    "le_intent": "le_intent.pkl",
+    "le_sentiment": "le_sentiment.pkl",
+    "le_priority": "le_priority.pkl",
+}
+LABEL_ENCODER_KEYS = ("le_intent", "le_sentiment", "le_priority")
+CLASSIFIER_HEADS = ("intent", "sentiment", "priority") # each head is m_<head> plus le_<head>
+
+class ModelRegistry:
+    """
+    Knows every classifier set shipped next to the app (`models/`, `models 2/`,
+    ..., and `models*.zip`) and swaps the active one atomically: the new set is
+    loaded alongside the old one and published with a single assignment, so
+    in-flight batches finish on the set they started with.
+    """
+
+    def __init__(self, root: str = MODEL_ROOT):
+        self.root = root
+        self.versions = {}
+        self.active = None
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def discover(self):
+        """Scans the model root for versions and records their metadata."""
+        found = {}
+        for entry in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, entry)
+            if not entry.startswith("models"):
+                continue
+            if os.path.isdir(path):
+                files = {key: os.path.join(path, name) for key, name in CLASSIFIER_FILES.items() if os.path.exists(os.path.join(path, name))}
+                if files:
+                    found[entry] = self._metadata(entry, path, files, {key: (lambda p=p: Path(p).read_bytes()) for key, p in files.items()})
+            elif entry.endswith(".zip"):
+                with zipfile.ZipFile(path) as archive:
+                    members = {
+                        key: info for info in archive.infolist() for key, name in CLASSIFIER_FILES.items()
+                        if os.path.basename(info.filename) == name and not info.filename.startswith("__MACOSX")
+                    }
+                    readers = {key: (lambda info=info: archive.read(info)) for key, info in members.items()}
+                    found[entry] = self._metadata(entry, path, members, readers, sizes={k: i.file_size for k, i in members.items()})
+        with self._lock:
+            for version, meta in found.items():
+                meta.update({k: v for k, v in self.versions.get(version, {}).items() if k in ("load_seconds", "loaded_at")})
+            self.versions = found
+        return list(found)
+
+    def default_version(self, preferred: str = DEFAULT_MODEL_VERSION) -> str:
+        """The preferred version if it is complete, otherwise the first complete one (after discover())."""
+        with self._lock:
+            complete = [version for version, meta in self.versions.items() if not meta['missing']]
+        if preferred in complete:
+            return preferred
+        if not complete:
+            raise FileNotFoundError(f"No complete model version found in '{self.root}'. ML will fail.")
+        return complete[0]
+
+    @staticmethod
+    def _metadata(version, path, files, readers, sizes=None):
+        sizes = sizes or {key: os.path.getsize(p) for key, p in files.items()}
+        digest = hashlib.sha256()
+        for key in LABEL_ENCODER_KEYS:
+            if key in readers:
+                digest.update(readers[key]())
+        return {
+            "version": version,
+            "path": path,
+            "size_bytes": sum(sizes.values()),
+            "missing": [CLASSIFIER_FILES[key] for key in CLASSIFIER_FILES if key not in files],
+            "label_encoder_checksum": digest.hexdigest()[:16],
+        }
+
+    def _extract(self, version):
+        """
+        Unpacks a zipped version into MODEL_CACHE_DIR and returns the directory
+        holding the pickles. Files already there with the archive's size and CRC
+        are kept, so only new or changed members are written.
+        """
+        target = os.path.join(MODEL_CACHE_DIR, version)
+        with zipfile.ZipFile(self.versions[version]['path']) as archive:
+            for info in archive.infolist():
+                name = os.path.basename(info.filename)
+                if name in CLASSIFIER_FILES.values() and not info.filename.startswith("__MACOSX"):
+                    path = os.path.join(target, name)
+                    if self._is_extracted(path, info):
+                        continue
+                    os.makedirs(target, exist_ok=True)
+                    with open(f"{path}.partial", 'wb') as f:
+                        f.write(archive.read(info))
+                    os.replace(f"{path}.partial", path)
+        return target
+
+    @staticmethod
+    def _is_extracted(path: str, info: zipfile.ZipInfo) -> bool:
+        if not os.path.exists(path) or os.path.getsize(path) != info.file_size:
+            return False
+        crc = 0
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                crc = zlib.crc32(block, crc)
+        return crc == info.CRC
+
+    def load(self, version: str, partial: bool = False) -> dict:
+        """
+        Loads (or returns the already loaded) classifier set for a version without
+        activating it. With partial=True an incomplete version loads the heads it
+        has in full; models['heads'] lists them.
+        """
+        with self._lock:
+            meta = self.versions.get(version)
+            loaded = self._loaded.get(version)
+        if meta is None:
+            raise KeyError(f"Unknown model version '{version}'.")
+        if meta['missing'] and not partial:
+            raise FileNotFoundError(f"Model version '{version}' is incomplete; missing {', '.join(meta['missing'])}.")
+        if loaded is not None:
+            return loaded
+
+        start = time.perf_counter()
+        directory = self._extract(version) if meta['path'].endswith(".zip") else meta['path']
+        models = {
+            key: joblib.load(os.path.join(directory, name))
+            for key, name in CLASSIFIER_FILES.items() if name not in meta['missing']
+        }
+        models['version'] = version
+        models['heads'] = [head for head in CLASSIFIER_HEADS if f"m_{head}" in models and f"le_{head}" in models]
+        if not models['heads']:
+            raise FileNotFoundError(f"Model version '{version}' has no complete classifier head.")
+        with self._lock:
+            meta['load_seconds'] = round(time.perf_counter() - start, 2)
+            meta['loaded_at'] = datetime.now().isoformat()
+            self._loaded[version] = models
+        return models
+
+    def activate(self, version: str) -> dict:
+        """Loads a version next to the current one and atomically makes it the active set."""
+        models = self.load(version)
+        with self._lock:
+            previous = self.active
+            ai_resources['classifiers'] = models
+            self.active = version
+            # Batches already running keep their own reference to the old set
+            if previous and previous != version:
+                self._loaded.pop(previous, None)
+        print(f"✅ Model Version Active: {version} (was {previous}).")
+        return self.versions[version]
+
+    def unload(self, version: str):
+        with self._lock:
+            if version != self.active:
+                self._loaded.pop(version, None)
+
+    def describe(self):
+        with self._lock:
+            return [
+                {**meta, "active": version == self.active, "loaded": version in self._loaded}
+                for version, meta in self.versions.items()
+            ]
+
+def current_models():
+    """The active classifier set. Read it once per batch so a hot-swap never mixes versions."""
+    return ai_resources.get('classifiers')
+
+def model_version_for(models) -> str:
+    """Tag stored with every analysis; also part of the analysis cache key."""
+    classifier_version = models['version'] if models else "none"
+    return f"{classifier_version}|{SUMMARIZER_CONFIG}"
+
+# --- SHADOW EVALUATION (CANDIDATE MODEL VERSION ON LIVE TRAFFIC) ---
+class ShadowEvaluator:
+    """
+    Scores a candidate classifier set against the primary one on a sampled
+    fraction of live traffic. Runs on its own thread, reuses the primary
+    embeddings (so only the classifier heads run twice) and drops samples
+    when it falls behind rather than slowing the request path. A candidate
+    missing some heads is compared on the heads it has.
+    """
+
+    LABELS = CLASSIFIER_HEADS
+
+    def __init__(self):
+        self.version = None
+        self.heads = ()
+        self.sample_rate = 0.0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=SHADOW_MAX_PENDING)
+        self._thread = None
+        self._reset()
+
+    def _reset(self):
+        self.started_at = datetime.now().isoformat()
+        self.compared = 0
+        self.dropped = 0
+        self.errors = 0
+        self.shadow_seconds = 0.0
+        self.disagreements = {label: 0 for label in self.LABELS}
+        self.confusions = {label: {} for label in self.LABELS}
+
+    def configure(self, version: str = None, sample_rate: float = 0.0):
+        """Points shadow mode at a candidate version (None disables it) and resets the counters."""
+        registry = ai_resources.get('model_registry')
+        heads = ()
+        if version:
+            if registry is None:
+                raise RuntimeError("Model registry unavailable.")
+            heads = tuple(registry.load(version, partial=True)['heads'])
+        with self._lock:
+            previous = self.version
+            self.version = version
+            self.heads = heads
+            self.sample_rate = min(max(sample_rate, 0.0), 1.0) if version else 0.0
+            self._reset()
+        if registry is not None and previous and previous != version:
+            registry.unload(previous)
+        if version and self._thread is None:
+            self._thread = threading.Thread(target=self._work, name="shadow-eval", daemon=True)
+            self._thread.start()
+
+    def maybe_submit(self, vecs, age_hours_list, results_list):
+        """Samples emails from a primary batch and queues them for the candidate. Never blocks."""
+        if not self.version or self.sample_rate <= 0:
+            return
+        picked = [
+            i for i, vec in enumerate(vecs)
+            if vec is not None and results_list[i]['detected_intent'] != "unknown" and random.random() < self.sample_rate
+        ]
+        if not picked:
+            return
+        job = {
+            "version": self.version,
+            "vecs": [vecs[i] for i in picked],
+            "age_hours": [age_hours_list[i] for i in picked],
+            "primary": [(results_list[i]['detected_intent'], results_list[i]['detected_sentiment'], results_list[i]['predicted_priority']) for i in picked],
+        }
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self.dropped += len(picked)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                candidate = ai_resources['model_registry'].load(job['version'], partial=True)
+                heads = candidate['heads']
+                start = time.perf_counter()
+                labels = list(zip(*_predict_labels(candidate, np.asarray(job['vecs']), job['age_hours'], heads)))
+                elapsed = time.perf_counter() - start
+            except Exception as e:
+                print(f"❌ Shadow Evaluation Error: {e}")
+                with self._lock:
+                    self.errors += 1
+                continue
+            with self._lock:
+                if job['version'] != self.version:
+                    continue # reconfigured while this job was queued
+                self.compared += len(labels)
+                self.shadow_seconds += elapsed
+                for primary, shadow in zip(job['primary'], labels):
+                    for label, s in zip(heads, shadow):
+                        p = primary[self.LABELS.index(label)]
+                        if p != s:
+                            self.disagreements[label] += 1
+                            pair = f"{p}->{s}"
+                            self.confusions[label][pair] = self.confusions[label].get(pair, 0) + 1
+
+    def report(self):
+        with self._lock:
+            compared = self.compared
+            return {
+                "primary_version": (current_models() or {}).get('version'),
+                "candidate_version": self.version,
+                "compared_heads": list(self.heads),
+                "sample_rate": self.sample_rate,
+                "since": self.started_at,
+                "compared": compared,
+                "pending": self._queue.qsize(),
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "disagreement_rate": {
+                    label: round(self.disagreements[label] / compared, 4) if compared and label in self.heads else None
+                    for label in self.LABELS
+                },
+                "top_disagreements": {
+                    label: dict(sorted(pairs.items(), key=lambda kv: -kv[1])[:10]) for label, pairs in self.confusions.items()
+                },
+                "added_latency_ms_per_email": round(self.shadow_seconds / compared * 1000, 3) if compared else None,
+            }
+
+shadow_evaluator = ShadowEvaluator()
+
+# --- COMPLIANCE & ROUTING RULE ENGINE ---
+SEVERITY_ORDER = {"low": 1, "medium": 2, "high": 3}
+
+def _trie_pattern(terms):
+    """
+    Compiles terms into one regex shaped like a trie (shared prefixes factored
+    out), so matching cost stays flat as the term list grows.
+    """
+    trie = {}
+    for term in terms:
+        node = trie
+        for char in term:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def emit(node):
+        if list(node) == [""]:
+            return ""
+        optional = "" in node
+        branches = [
+            (r"\s+" if char == " " else re.escape(char)) + emit(child)
+            for char, child in sorted(node.items()) if char
+        ]
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if optional:
+            body = f"{body}?" if len(branches) > 1 or len(branches[0]) == 1 else f"(?:{body})?"
+        return body
+
+    return emit(trie)
+
+class RuleEngine:
+    """
+    Table-driven compliance detection and routing loaded from RULES_FILE.
+    All compliance terms are compiled into a single word-bounded regex, so each
+    email is scanned once; the file is re-read when it changes on disk.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0.0
+        self._compiled = None
+        self.reload()
+
+    def reload(self):
+        """Re-reads the rules file. A broken file is reported and the previous rules stay active."""
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, encoding="utf-8") as f:
+                compiled = self._compile(json.load(f))
+        except Exception as e:
+            print(f"❌ Rules Load Error ({self.path}): {e}")
+            if self._compiled is None:
+                raise
+            return False
+        with self._lock:
+            self._compiled = compiled
+            self._mtime = mtime
+        print(f"✅ Rules Loaded: {len(compiled['terms'])} compliance terms, {len(compiled['routes'])} routing rules.")
+        return True
+
+    @staticmethod
+    def _compile(config):
+        terms = {}
+        for rule in config.get("compliance", []):
+            severity = rule.get("severity", "medium")
+            if severity not in SEVERITY_ORDER:
+                raise ValueError(f"Unknown severity '{severity}' for '{rule['label']}'.")
+            for term in rule["terms"]:
+                key = " ".join(term.lower().split())
+                terms.setdefault(key, []).append((rule["label"], severity))
+        pattern = re.compile(r"\b(?:" + _trie_pattern(sorted(terms)) + r")\b", re.IGNORECASE) if terms else None
+
+        routes = []
+        for rule in config.get("routing", []):
+            when = rule.get("when", {})
+            unknown = set(when) - {"intent", "sentiment", "priority", "intent_contains"}
+            if unknown:
+                raise ValueError(f"Unknown routing condition(s): {', '.join(sorted(unknown))}")
+            routes.append(({field: tuple(v.lower() for v in values) for field, values in when.items()}, rule["action"], rule["why"]))
+        default = config.get("default_route", {"action": "Standard Reply", "why": "Routine inquiry."})
+        return {"pattern": pattern, "terms": terms, "routes": routes, "default": (default["action"], default["why"])}
+
+    def _current(self):
+        # Stat the file at most every RULES_RELOAD_INTERVAL seconds
+        now = time.monotonic()
+        if now - self._checked_at >= RULES_RELOAD_INTERVAL:
+            self._checked_at = now
+            try:
+                if os.path.getmtime(self.path) != self._mtime:
+                    self.reload()
+            except OSError:
+                pass
+        return self._compiled
+
+    def compliance(self, text: str):
+        """Returns ([labels], highest severity or None) from a single pass over the text."""
+        compiled = self._current()
+        if compiled["pattern"] is None or not text:
+            return [], None
+        labels = {}
+        for match in compiled["pattern"].finditer(text):
+            for label, severity in compiled["terms"].get(" ".join(match.group(0).lower().split()), []):
+                if SEVERITY_ORDER[severity] > SEVERITY_ORDER.get(labels.get(label), 0):
+                    labels[label] = severity
+        if not labels:
+            return [], None
+        return list(labels), max(labels.values(), key=SEVERITY_ORDER.get)
+
+    def route(self, intent: str, sentiment: str, priority: str):
+        """Returns (recommended_action, why) from the first routing rule whose conditions all hold."""
+        compiled = self._current()
+        values = {"intent": intent.lower(), "sentiment": sentiment.lower(), "priority": priority.lower()}
+        for when, action, why in compiled["routes"]:
+            if all(
+                any(part in values["intent"] for part in expected) if field == "intent_contains" else values[field] in expected
+                for field, expected in when.items()
+            ):
+                return action, why
+        return compiled["default"]
+
+rule_engine = RuleEngine(RULES_FILE)
+
+# --- ANALYSIS CACHE (SKIP INFERENCE FOR REPEATED BODIES) ---
+class AnalysisCache:
+    """
+    Persistent LRU cache of model outputs keyed by a hash of the normalized body
+    plus the model version. Backed by a local SQLite file so it survives restarts.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS analysis_cache ("
+            "key TEXT PRIMARY KEY, payload TEXT NOT NULL, embedding BLOB, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_used ON analysis_cache (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(text: str, model_version: str) -> str:
+        normalized = " ".join(text.split())
+        return hashlib.sha256(f"{model_version}\x00{normalized}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """Returns {key: (payload, embedding)} for every cached key and refreshes their recency."""
+        unique_keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, payload, embedding FROM analysis_cache WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                for key, payload, embedding in rows:
+                    vec = np.frombuffer(embedding, dtype=np.float32) if embedding is not None else None
+                    found[key] = (json.loads(payload), vec)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE analysis_cache SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+                self._conn.commit()
+            self.hits += sum(1 for k in keys if k in found)
+            self.misses += sum(1 for k in keys if k not in found)
+        return found
+
+    def put_many(self, entries):
+        """Stores (key, payload, embedding) tuples and evicts the least recently used rows past max_entries."""
+        if not entries:
+            return
+        now = time.time()
+        rows = [
+            (key, json.dumps(payload), None if vec is None else np.asarray(vec, dtype=np.float32).tobytes(), now)
+            for key, payload, vec in entries
+        ]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO analysis_cache VALUES (?, ?, ?, ?)", rows)
+            overflow = self._conn.execute("SELECT COUNT(*) FROM analysis_cache").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM analysis_cache WHERE key IN "
+                    "(SELECT key FROM analysis_cache ORDER BY last_used ASC LIMIT ?)",
+                    (overflow,)
+                )
+                self.evictions += overflow
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM analysis_cache").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "size": size,
+            "max_entries": self.max_entries
+        }
+
+def cache_payload(results: dict) -> dict:
+    """The model outputs worth caching; priority is left out because it depends on email age."""
+    return {
+        "detected_intent": results['detected_intent'],
+        "detected_sentiment": results['detected_sentiment'],
+        "summary": results['summary'],
+        "compliance_alerts": results['compliance_alerts']
+    }
+
+def current_model_version():
+    return model_version_for(current_models())
+
+# --- FULL ANALYSIS PIPELINE ---
+def _default_insights():
+    return {
+        "detected_intent": "unknown", "detected_sentiment": "neutral", "predicted_priority": "low",
+        "summary": "Processing...", "compliance_alerts": [], "compliance_severity": None
+    }
+
+def _predict_labels(models, vecs, age_hours_list, heads=CLASSIFIER_HEADS):
+    """Runs classifier heads (all three by default) of one model set on precomputed embeddings. Returns one label list per head."""
+    hybrid_vecs = np.column_stack((vecs, np.asarray(age_hours_list, dtype=float)))
+
+    version = models.get('version')
+    labels = []
+    for head in heads:
+        with metrics.time(f"classify_{head}", "mail_classifier_seconds", version=version):
+            predicted = models[f"m_{head}"].predict(hybrid_vecs if head == "priority" else vecs)
+        # FIX: Force lowercase and strip whitespace for PostgreSQL ENUM compatibility
+        labels.append([str(label).lower().strip() for label in models[f"le_{head}"].inverse_transform(predicted)])
+    return tuple(labels)
+
+def _classify_batch(texts, age_hours_list, results_list, models, known_vecs=None):
+    """
+    Embeds all texts in one call and runs each classifier once on the stacked matrix.
+    Texts with a vector in `known_vecs` are not re-encoded. Returns the embeddings.
+    """
+    if models is None or 'embedder' not in ai_resources:
+        return None
+    try:
+        vecs = list(known_vecs) if known_vecs is not None else [None] * len(texts)
+        missing = [i for i, vec in enumerate(vecs) if vec is None]
+        if missing:
+            with metrics.time("embed"):
+                encoded = ai_resources['embedder'].encode([texts[i] for i in missing])
+            for i, vec in zip(missing, encoded):
+                vecs[i] = vec
+        vecs = np.asarray(vecs, dtype=np.float32)
+        intents, sentiments, priorities = _predict_labels(models, vecs, age_hours_list)
+
+        for results, intent, sentiment, priority in zip(results_list, intents, sentiments, priorities):
+            results['detected_intent'] = intent
+            results['detected_sentiment'] = sentiment
+            results['predicted_priority'] = priority
+        return vecs
+    except Exception as e:
+        print(f"Classification Error: {e}")
+        metrics.error("classify")
+        return None
+
+def _predict_priority_batch(vecs, age_hours_list, models):
+    """Re-runs only the age-dependent priority head on stored embeddings."""
+    hybrid_vecs = np.column_stack((np.asarray(vecs), np.asarray(age_hours_list, dtype=float)))
+    preds = models['m_priority'].predict(hybrid_vecs)
+    return [str(p).lower().strip() for p in models['le_priority'].inverse_transform(preds)]
+
+def _generate_summaries(texts):
+    """Summarizes a list of texts with the loaded summarizer (see SummarizerBackend.summarize)."""
+    with metrics.time("summarize"):
+        return ai_resources['summarizer'].summarize(texts)
+
+EMPTY_BODY_SUMMARY = "No text content in this email."
+SUMMARIZER_UNAVAILABLE_SUMMARY = "Summarizer failed to load. (AI Error Fallback)"
+
+FALLBACK_SUMMARIES = {
+    "Processing...",
+    "Model produced a blank summary. (AI Error Fallback)",
+    "Summary generation failed due to complex/long input.",
+    SUMMARIZER_UNAVAILABLE_SUMMARY
+}
+
+def _finalize_summary(summary):
+    # Final Safety Check: If the summary is still blank, provide a fallback
+    if not summary or len(summary.strip()) < 5:
+        metrics.inc("mail_fallback_summaries_total", reason="blank")
+        return "Model produced a blank summary. (AI Error Fallback)"
+    return summary
+
+def _summarize_batch(texts, results_list, batch_size):
+    """Summarizes texts in padded batches; a failing batch is retried one email at a time."""
+    if 'summarizer' not in ai_resources:
+        return
+
+    # Group similar lengths together so each padded batch wastes as little compute as possible
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+
+    for start in range(0, len(order), batch_size):
+        idxs = order[start:start + batch_size]
+        try:
+            summaries = _generate_summaries([texts[i] for i in idxs])
+            for i, summary in zip(idxs, summaries):
+                results_list[i]['summary'] = _finalize_summary(summary)
+        except Exception as e:
+            print(f"Summarizer Batch Error: {e}")
+            metrics.error("summarize_batch")
+            for i in idxs:
+                try:
+                    results_list[i]['summary'] = _finalize_summary(_generate_summaries([texts[i]])[0])
+                except Exception as e:
+                    print(f"Summarizer Runtime Error: {e}")
+                    metrics.inc("mail_fallback_summaries_total", reason="error")
+                    results_list[i]['summary'] = "Summary generation failed due to complex/long input."
+
+def _apply_compliance(text: str, results: dict):
+    # Compliance Check
+    with metrics.time("rules_compliance"):
+        results['compliance_alerts'], results['compliance_severity'] = rule_engine.compliance(text)
+
+def _agent_assist(results: dict):
+    """Applies the routing rules to one classified email."""
+    with metrics.time("rules_routing"):
+        return rule_engine.route(results['detected_intent'], results['detected_sentiment'], results['predicted_priority'])
+
+def _infer_unique(texts, age_hours_list, batch_size, models, summarize=True, known_vecs=None):
+    """Runs the models on texts that missed the cache. Returns (results_list, embeddings or None)."""
+    results_list = [_default_insights() for _ in texts]
+    vecs = _classify_batch(texts, age_hours_list, results_list, models, known_vecs)
+    if summarize:
+        _summarize_batch(texts, results_list, batch_size)
+    for text, results in zip(texts, results_list):
+        _apply_compliance(text, results)
+    return results_list, vecs
+
+def _apply_cache_hits(texts, hit_idxs, hit_payloads, age_hours_list, results_list, models):
+    """Fills results for cache hits, recomputing only the age-dependent priority and the (cheap, hot-reloadable) rules."""
+    for i, (payload, _) in zip(hit_idxs, hit_payloads):
+        results_list[i].update(payload)
+        _apply_compliance(texts[i], results_list[i])
+    if models is None:
+        return
+    try:
+        priorities = _predict_priority_batch(
+            [vec for _, vec in hit_payloads],
+            [age_hours_list[i] for i in hit_idxs],
+            models
+        )
+        for i, priority in zip(hit_idxs, priorities):
+            results_list[i]['predicted_priority'] = priority
+    except Exception as e:
+        print(f"Cached Priority Error: {e}")
+
+def run_analysis_batch(texts, received_dts, batch_size: int = None, return_embeddings: bool = False, summarize: bool = True,
+                       embeddings=None):
+    """
+    Analyzes many emails at once. Produces the same output as calling
+    run_analysis_pipeline on each email, but embeds once, runs each classifier
+    once and summarizes in padded batches of `batch_size` (SUMMARY_BATCH_SIZE by default).
+    Bodies already in the analysis cache skip model inference entirely.
+    With return_embeddings=True, returns (analyses, embeddings) so callers can
+    keep each email's vector without re-encoding it. With summarize=False,
+    cache misses keep the "Processing..." summary for the SummaryQueue to fill.
+    Stored vectors passed as `embeddings` (None where unknown) are reused instead
+    of re-encoding those emails. Empty bodies skip inference and get default labels.
+    """
+    if len(texts) != len(received_dts):
+        raise ValueError("texts and received_dts must have the same length.")
+    if not texts:
+        return ([], []) if return_embeddings else []
+    batch_size = max(1, batch_size or SUMMARY_BATCH_SIZE)
+
+    # --- 1. Metadata ---
+    now = datetime.now()
+    age_hours_list = [(now - dt).total_seconds() / 3600 for dt in received_dts]
+    results_list = [_default_insights() for _ in texts]
+    known_vecs = embeddings
+    embeddings = [None] * len(texts)
+    models = current_models()
+    version = model_version_for(models)
+    # Nothing to classify or summarize in a body without text
+    empty_idxs = {i for i, text in enumerate(texts) if not text or not text.strip()}
+    for i in empty_idxs:
+        results_list[i]['summary'] = EMPTY_BODY_SUMMARY
+    if empty_idxs:
+        metrics.inc("mail_empty_bodies_total", len(empty_idxs))
+
+    # --- 2. Cache Lookup ---
+    cache = ai_resources.get('analysis_cache')
+    keys = [None] * len(texts)
+    cached = {}
+    if cache is not None:
+        try:
+            keys = [None if i in empty_idxs else AnalysisCache.make_key(text, version) for i, text in enumerate(texts)]
+            cached = cache.get_many(keys)
+        except Exception as e:
+            print(f"Analysis Cache Read Error: {e}")
+            cached = {}
+
+    hit_idxs = [i for i, key in enumerate(keys) if key in cached and cached[key][1] is not None]
+    metrics.inc("mail_emails_analyzed_total", len(hit_idxs), source="cache")
+    metrics.inc("mail_emails_analyzed_total", len(texts) - len(hit_idxs) - len(empty_idxs), source="model")
+    for i in hit_idxs:
+        embeddings[i] = cached[keys[i]][1]
+    if hit_idxs:
+        _apply_cache_hits(texts, hit_idxs, [cached[keys[i]] for i in hit_idxs], age_hours_list, results_list, models)
+
+    # --- 3. Classification & Summarization (Model Inference) ---
+    # Identical bodies within one sync are only inferred once
+    skipped = set(hit_idxs) | empty_idxs
+    groups = {}
+    for i, text in enumerate(texts):
+        if i not in skipped:
+            groups.setdefault(keys[i] or text, []).append(i)
+
+    if groups:
+        reps = [idxs[0] for idxs in groups.values()]
+        unique_results, vecs = _infer_unique(
+            [texts[i] for i in reps], [age_hours_list[i] for i in reps], batch_size, models, summarize,
+            [known_vecs[i] for i in reps] if known_vecs is not None else None
+        )
+        to_store = []
+        for n, (idxs, results) in enumerate(zip(groups.values(), unique_results)):
+            for i in idxs:
+                if vecs is not None:
+                    embeddings[i] = vecs[n]
+                results_list[i].update(results)
+                results_list[i]['compliance_alerts'] = list(results['compliance_alerts'])
+            if len(idxs) > 1 and vecs is not None and models is not None:
+                # Duplicates can differ in age, so priority is still per email
+                try:
+                    priorities = _predict_priority_batch([vecs[n]] * len(idxs), [age_hours_list[i] for i in idxs], models)
+                    for i, priority in zip(idxs, priorities):
+                        results_list[i]['predicted_priority'] = priority
+                except Exception as e:
+                    print(f"Duplicate Priority Error: {e}")
+            if cache is not None and keys[idxs[0]] and vecs is not None and results['summary'] not in FALLBACK_SUMMARIES:
+                to_store.append((keys[idxs[0]], cache_payload(results), vecs[n]))
+        if to_store:
+            try:
+                cache.put_many(to_store)
+            except Exception as e:
+                print(f"Analysis Cache Write Error: {e}")
+
+    # Off the request path: the candidate model only sees a sample of this batch
+    shadow_evaluator.maybe_submit(embeddings, age_hours_list, results_list)
+
+    # --- 4. Agent Assist Logic ---
+    analyses = []
+    for received_at_dt, age_hours, results in zip(received_dts, age_hours_list, results_list):
+        results['model_version'] = version
+        rec_action, why = _agent_assist(results)
+        analyses.append({
+            "email_metadata": {
+                "received_at": str(received_at_dt),
+                "age_hours": f"{age_hours:.1f}"
+            },
+            "ai_insights": results,
+            "agent_assist": {
+                "recommended_action": rec_action,
+                "why?": why,
+                "compliance_alerts": results['compliance_alerts'],
+                "compliance_severity": results['compliance_severity']
+            }
+        })
+    if return_embeddings:
+        return analyses, embeddings
+    return analyses
+
+def run_analysis_pipeline(text: str, received_at_dt: datetime):
+    return run_analysis_batch([text], [received_at_dt])[0]
+
+
+# --- EMAIL LISTING HELPERS (SERVER-SIDE FILTERS + KEYSET PAGINATION) ---
+EMAIL_LIST_FIELDS = {
+    "id", "sender_email", "subject_line", "body_content", "is_read",
+    "received_at", "conversation_thread_id", "escalated_to"
+}
+
+def encode_cursor(row: dict) -> str:
+    raw = json.dumps({"received_at": row['received_at'], "id": row['id']})
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        # Re-serialized because it is spliced into the or_() filter string
+        received_at = datetime.fromisoformat(str(data['received_at']).replace("Z", "+00:00")).isoformat()
+        return received_at, int(data['id'])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+def _email_select(fields: str = None, include_body: bool = True, inner_join: bool = False):
+    """Builds the select clause. id and received_at are always kept because the cursor needs them."""
+    if fields:
+        columns = {f.strip() for f in fields.split(",") if f.strip()}
+        unknown = columns - EMAIL_LIST_FIELDS
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    else:
+        columns = set(EMAIL_LIST_FIELDS)
+    columns |= {"id", "received_at"}
+    if not include_body:
+        columns.discard("body_content")
+    join = "email_analysis!inner(*)" if inner_join else "email_analysis(*)"
+    return ", ".join(sorted(columns)) + f", {join}"
+
+def fetch_email_page(db, limit: int, cursor: str = None, filter_priority: str = None,
+                     filter_sentiment: str = None, fields: str = None, include_body: bool = True):
+    """
+    Fetches one page of emails newest-first with filters applied in the query.
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    filtered = bool(filter_priority or filter_sentiment)
+    query = db.table("emails").select(_email_select(fields, include_body, inner_join=filtered))
+    if filter_priority:
+        query = query.eq("email_analysis.urgency_score", filter_priority)
+    if filter_sentiment:
+        query = query.eq("email_analysis.sentiment", filter_sentiment)
+    if cursor:
+        received_at, last_id = decode_cursor(cursor)
+        query = query.or_(f'received_at.lt."{received_at}",and(received_at.eq."{received_at}",id.lt.{last_id})')
+
+    # One extra row tells us whether another page exists
+    response = query.order("received_at", desc=True).order("id", desc=True).limit(limit + 1).execute()
+    rows = response.data or []
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def format_email_rows(rows):
+    """Flattens the joined analysis and attaches suggested resolutions for unresolved emails."""
+    formatted_emails = []
+    for row in rows:
+        analysis_data = row.get("email_analysis")
+        analysis = analysis_data[0] if isinstance(analysis_data, list) and analysis_data else (analysis_data if analysis_data else {})
+        formatted_emails.append({**row, "analysis": analysis})
+
+    # Suggested resolutions for UNRESOLVED emails, looked up in bulk and joined in memory
+    unresolved = [item for item in formatted_emails if item['analysis'].get('resolved_at') is None]
+    suggestions = suggest_resolutions(
+        [item['id'] for item in unresolved],
+        [item.get('body_content') for item in unresolved],
+        [(item['analysis'].get('extracted_entities') or {}).get('intent') for item in unresolved]
+    )
+    for item, suggested_resolution in zip(unresolved, suggestions):
+        if suggested_resolution:
+            item['analysis']['suggested_resolution'] = suggested_resolution
+    return formatted_emails
+
+
+# --- BULK PERSISTENCE ---
+def analysis_row(email_id: int, analysis_result: dict, include_summary: bool = True) -> dict:
+    """Maps one analysis to its email_analysis row. Without the summary, an upsert leaves the stored one alone."""
+    insights = analysis_result['ai_insights']
+    assist = analysis_result['agent_assist']
+    row = {"email_id": email_id}
+    if include_summary:
+        row["summary_text"] = insights['summary']
+        row["summary_status"] = "pending" if insights['summary'] == "Processing..." else "done"
+    row.update({
+        "sentiment": insights['detected_sentiment'],
+        "urgency_score": insights['predicted_priority'],
+        "compliance_flag": len(assist['compliance_alerts']) > 0,
+        "compliance_reason": ", ".join(assist['compliance_alerts']),
+        "recommended_action": assist['recommended_action'],
+        "action_reason": assist['why?'], # Fixed column name
+        "extracted_entities": {"intent": insights['detected_intent'], "model_version": insights['model_version']}
+    })
+    return row
+
+def _is_row_error(error: Exception) -> bool:
+    """PostgreSQL data exceptions (SQLSTATE 22xxx) and constraint violations (23xxx) are caused by specific rows."""
+    return isinstance(error, APIError) and str(getattr(error, 'code', None) or "")[:2] in ("22", "23")
+
+def bulk_upsert(db, table: str, rows, on_conflict: str):
+    """
+    Upserts rows in chunks of DB_WRITE_CHUNK_SIZE. A chunk rejected for its data
+    is split in half and retried, so only the rows that actually fail are left
+    out. Any other error (connection, timeout, 5xx) is raised as is.
+    Returns (written_rows, failed_rows).
+    """
+    written, failed = [], []
+    stack = [rows[i:i + DB_WRITE_CHUNK_SIZE] for i in range(0, len(rows), DB_WRITE_CHUNK_SIZE)][::-1]
+    while stack:
+        chunk = stack.pop()
+        try:
+            with metrics.time(f"upsert_{table}", "mail_db_seconds"):
+                response = db.table(table).upsert(chunk, on_conflict=on_conflict).execute()
+            written.extend(response.data or [])
+        except Exception as e:
+            if not _is_row_error(e):
+                raise
+            if len(chunk) == 1:
+                print(f"❌ {table} Write Error ({chunk[0].get(on_conflict)}): {e}")
+                failed.extend(chunk)
+            else:
+                mid = len(chunk) // 2
+                stack.extend([chunk[mid:], chunk[:mid]])
+    return written, failed
+
+def persist_analyzed_emails(db, pending, analyses):
+    """
+    Saves a batch of analyzed messages in two bulk requests: all emails rows, then
+    all email_analysis rows. Both are upserts (on conversation_thread_id and
+    email_id), so re-running a sync is idempotent.
+    Returns ({conversation_thread_id: email id} for fully stored messages, failed count).
+    """
+    email_rows = [{
+        "sender_email": item['sender'],
+        "subject_line": item['subject'],
+        "body_content": item['body_content'],
+        "received_at": item['received_dt'].isoformat(),
+        "conversation_thread_id": item['msg_id']
+    } for item in pending]
+    written, failed = bulk_upsert(db, "emails", email_rows, on_conflict="conversation_thread_id")
+    ids = {row['conversation_thread_id']: row['id'] for row in written}
+
+    analysis_rows = [
+        analysis_row(ids[item['msg_id']], analysis_result)
+        for item, analysis_result in zip(pending, analyses) if item['msg_id'] in ids
+    ]
+    _, failed_analyses = bulk_upsert(db, "email_analysis", analysis_rows, on_conflict="email_id")
+
+    failed_email_ids = {row['email_id'] for row in failed_analyses}
+    stored = {thread_id: email_id for thread_id, email_id in ids.items() if email_id not in failed_email_ids}
+    return stored, len(pending) - len(stored)
+
+# --- ASYNC SUMMARY QUEUE ---
+class SummaryQueue:
+    """
+    Fills in summaries after classification has already been saved. Jobs are
+    served highest-risk first (high priority or angry, then medium, then low)
+    by a small pool of workers that summarize in batches and write back in bulk.
+    """
+
+    RANKS = {"high": 1, "medium": 2, "low": 3}
+
+    def __init__(self, workers: int = None, batch_size: int = None):
+        self.workers = max(1, workers or SUMMARY_WORKERS)
+        self.batch_size = max(1, batch_size or SUMMARY_BATCH_SIZE)
+        self.completed = 0
+        self.failed = 0
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._threads = []
+
+    @classmethod
+    def rank(cls, priority: str, sentiment: str) -> int:
+        if sentiment == 'angry':
+            return 0
+        return cls.RANKS.get(priority, len(cls.RANKS) + 1)
+
+    def start(self):
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"summary-worker-{n}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, email_id: int, text: str, priority: str, sentiment: str, cache_key: str = None, cache_payload: dict = None, vec=None):
+        job = {"email_id": email_id, "text": text, "cache_key": cache_key, "cache_payload": cache_payload, "vec": vec}
+        self._queue.put((self.rank(priority, sentiment), next(self._seq), job))
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self):
+        return {"pending": self.depth(), "completed": self.completed, "failed": self.failed, "workers": self.workers}
+
+    def _next_batch(self):
+        batch = [self._queue.get()[2]]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait()[2])
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            db = ai_resources.get('db')
+            if 'summarizer' not in ai_resources and db is not None and component_failed("summarizer"):
+                # It will never load, so fail the jobs instead of leaving them pending forever
+                self._fail_unavailable(db, batch)
+                continue
+            if 'summarizer' not in ai_resources or db is None:
+                # Models still loading: put the work back and wait
+                for job in batch:
+                    self._queue.put((0, next(self._seq), job))
+                time.sleep(1.0)
+                continue
+            try:
+                results_list = [{"summary": "Processing..."} for _ in batch]
+                _summarize_batch([job['text'] for job in batch], results_list, self.batch_size)
+                rows = [{
+                    "email_id": job['email_id'],
+                    "summary_text": results['summary'],
+                    "summary_status": "failed" if results['summary'] in FALLBACK_SUMMARIES else "done"
+                } for job, results in zip(batch, results_list)]
+                _, failed = bulk_upsert(db, "email_analysis", rows, on_conflict="email_id")
+                failed_ids = {row['email_id'] for row in failed} | {row['email_id'] for row in rows if row['summary_status'] == "failed"}
+                self.completed += len(rows) - len(failed_ids)
+                self.failed += len(failed_ids)
+                self._cache_summaries(batch, results_list)
+            except Exception as e:
+                print(f"❌ Summary Worker Error: {e}")
+                self.failed += len(batch)
+
+    def _fail_unavailable(self, db, batch):
+        rows = [{"email_id": job['email_id'], "summary_text": SUMMARIZER_UNAVAILABLE_SUMMARY, "summary_status": "failed"} for job in batch]
+        metrics.inc("mail_fallback_summaries_total", len(rows), reason="unavailable")
+        try:
+            bulk_upsert(db, "email_analysis", rows, on_conflict="email_id")
+        except Exception as e:
+            print(f"❌ Summary Worker Error: {e}")
+        self.failed += len(rows)
+
+    @staticmethod
+    def _cache_summaries(batch, results_list):
+        cache = ai_resources.get('analysis_cache')
+        if cache is None:
+            return
+        entries = [
+            (job['cache_key'], {**job['cache_payload'], "summary": results['summary']}, job['vec'])
+            for job, results in zip(batch, results_list)
+            if job['cache_key'] and job['cache_payload'] and job['vec'] is not None and results['summary'] not in FALLBACK_SUMMARIES
+        ]
+        try:
+            cache.put_many(entries)
+        except Exception as e:
+            print(f"Analysis Cache Write Error: {e}")
+
+def requeue_pending_summaries(summary_queue: SummaryQueue):
+    """Re-submits summaries left pending by a previous process."""
+    db = ai_resources['db']
+    response = db.table("email_analysis").select(
+        "email_id, urgency_score, sentiment, emails(body_content)"
+    ).eq("summary_status", "pending").execute()
+    for row in response.data or []:
+        text = (row.get('emails') or {}).get('body_content') or ""
+        summary_queue.submit(row['email_id'], text, row.get('urgency_score'), row.get('sentiment'))
+    return len(response.data or [])
+
+# --- THE GMAIL SYNC FUNCTION ---
+class StageTimings:
+    """Thread-safe accumulator of wall time per sync stage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            return {name: {"seconds": round(secs, 3), "calls": self.counts[name]} for name, secs in self.seconds.items()}
+
+class SyncRunLog:
+    """
+    Keeps each sync run (status, counts, per-stage timings) queryable by run id.
+    The last SYNC_RUN_HISTORY runs stay in memory; finished runs are also appended
+    to a JSONL file so they survive restarts. The file is rewritten with just the
+    last max_runs records whenever it reaches twice that many lines.
+    """
+
+    def __init__(self, path: str, max_runs: int = 100):
+        self.path = path
+        self.max_runs = max_runs
+        self._lock = threading.Lock()
+        self._runs = None # run_id -> run, oldest first; read from disk on first use
+        self._lines = 0   # records in the file
+
+    def _loaded(self):
+        if self._runs is None:
+            self._runs = {}
+            if self.path and os.path.exists(self.path):
+                lines = deque(maxlen=self.max_runs)
+                with open(self.path) as f:
+                    for line in f:
+                        lines.append(line)
+                        self._lines += 1
+                for line in lines:
+                    try:
+                        run = json.loads(line)
+                        self._runs[run['run_id']] = run
+                    except (ValueError, KeyError):
+                        continue
+        return self._runs
+
+    def start(self, mailbox: str, run_id: str = None, status: str = "running") -> str:
+        """Registers a run (or moves a queued one to `status`) and returns its id."""
+        with self._lock:
+            runs = self._loaded()
+            run_id = run_id or uuid.uuid4().hex[:12]
+            run = runs.setdefault(run_id, {"run_id": run_id, "mailbox": mailbox, "queued_at": datetime.now().isoformat()})
+            run['status'] = status
+            if status == "running":
+                run['started_at'] = datetime.now().isoformat()
+            while len(runs) > self.max_runs:
+                runs.pop(next(iter(runs)))
+        return run_id
+
+    def finish(self, run_id: str, status: str, **fields):
+        with self._lock:
+            runs = self._loaded()
+            run = runs.setdefault(run_id, {"run_id": run_id})
+            run.update(fields, status=status, finished_at=datetime.now().isoformat())
+            if self.path:
+                try:
+                    self._write(json.dumps(run) + "\n", runs)
+                except OSError as e:
+                    print(f"Sync Run Log Write Error: {e}")
+
+    def _write(self, line: str, runs: dict):
+        if self._lines + 1 < 2 * self.max_runs:
+            with open(self.path, "a") as f:
+                f.write(line)
+            self._lines += 1
+            return
+        # Rewrite with the finished runs still kept in memory (this one included)
+        records = [json.dumps(run) + "\n" for run in runs.values() if 'finished_at' in run][-self.max_runs:]
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(records)
+        os.replace(tmp_path, self.path)
+        self._lines = len(records)
+
+    def get(self, run_id: str):
+        with self._lock:
+            run = self._loaded().get(run_id)
+            return dict(run) if run else None
+
+    def recent(self, limit: int = 20):
+        with self._lock:
+            return [dict(run) for run in reversed(list(self._loaded().values())[-limit:])]
+
+sync_runs = SyncRunLog(SYNC_RUNS_FILE, SYNC_RUN_HISTORY)
+
+def _is_retryable(error: Exception) -> bool:
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    return isinstance(error, HttpError) and status is not None and (int(status) == 429 or int(status) >= 500)
+
+def _is_gone(error: Exception) -> bool:
+    """404/410: the message was deleted after history listed it, so there is nothing to retry."""
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    return isinstance(error, HttpError) and status is not None and int(status) in (404, 410)
+
+def call_with_backoff(fn, *args, **kwargs):
+    """Calls a Gmail operation, retrying 429/5xx responses with exponential backoff and jitter."""
+    for attempt in range(GMAIL_MAX_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as error:
+            if attempt == GMAIL_MAX_RETRIES or not _is_retryable(error):
+                raise
+            metrics.inc("mail_gmail_retries_total", call=getattr(fn, '__name__', 'unknown'))
+            delay = GMAIL_BACKOFF_BASE * (2 ** attempt)
+            time.sleep(delay + random.uniform(0, delay))
+
+def parse_message(msg_id: str, message: dict, client: GmailClient = None) -> dict:
+    """Extracts the fields the sync stores from a full Gmail message. Bodies behind an attachmentId are fetched with client."""
+    def fetch_attachment(attachment_id):
+        with metrics.time("gmail_attachment"):
+            return call_with_backoff(client.get_attachment, msg_id, attachment_id)
+
+    headers = {h['name']: h['value'] for h in message['payload'].get('headers', [])}
+    received_timestamp = float(message['internalDate']) / 1000.0 # Convert milliseconds to seconds
+    return {
+        "msg_id": msg_id,
+        "sender": headers.get('From', 'Unknown Sender'),
+        "subject": headers.get('Subject', 'No Subject'),
+        "received_dt": datetime.fromtimestamp(received_timestamp),
+        "body_content": get_email_body(message, fetch_attachment if client is not None else None)
+    }
+
+def _summary_queue():
+    return ai_resources.get('summary_queue') if SUMMARY_MODE == "async" else None
+
+def analyze_pending(pending):
+    """Runs the models over parsed messages. Returns (analyses, embeddings)."""
+    return run_analysis_batch(
+        [item['body_content'] for item in pending],
+        [item['received_dt'] for item in pending],
+        return_embeddings=True,
+        summarize=_summary_queue() is None
+    )
+
+def store_analyzed(db, pending, analyses, embeddings, timings: StageTimings):
+    """Saves analyzed messages, their vectors and any deferred summary jobs. Returns (stored, failed)."""
+    summary_queue = _summary_queue()
+    with timings.stage("persist"):
+        stored, failed = persist_analyzed_emails(db, pending, analyses)
+
+    store = ai_resources.get('embedding_store')
+    if store is not None:
+        kept = [(stored[item['msg_id']], vec) for item, vec in zip(pending, embeddings) if item['msg_id'] in stored and vec is not None]
+        try:
+            store.put_many([email_id for email_id, _ in kept], [vec for _, vec in kept])
+        except Exception as e:
+            print(f"Embedding Store Write Error: {e}")
+
+    for item, analysis_result, vec in zip(pending, analyses, embeddings):
+        if item['msg_id'] not in stored:
+            continue
+        email_id = stored[item['msg_id']]
+        insights = analysis_result['ai_insights']
+        if summary_queue is not None and insights['summary'] == "Processing...":
+            summary_queue.submit(
+                email_id, item['body_content'], insights['predicted_priority'], insights['detected_sentiment'],
+                AnalysisCache.make_key(item['body_content'], insights['model_version']), cache_payload(insights), vec
+            )
+    return len(stored), failed
+
+class InferencePool:
+    """
+    The model stage shared by every mailbox's sync. Syncs hand in their batches
+    and block until they are stored; a worker merges whatever batches are waiting
+    (stopping once INFERENCE_MAX_BATCH emails are reached) into one model call, so concurrent syncs
+    share the models instead of contending for them.
+    """
+
+    def __init__(self, workers: int = None, max_batch: int = None):
+        self.workers = max(1, workers or INFERENCE_WORKERS)
+        self.max_batch = max(1, max_batch or INFERENCE_MAX_BATCH)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = {} # mailbox -> emails waiting or being analyzed
+        self._threads = []
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"inference-worker-{n}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def run(self, db, pending, timings: StageTimings, mailbox: str = DEFAULT_MAILBOX):
+        """Analyzes and stores one sync batch on the shared workers. Returns (stored, failed)."""
+        self._start()
+        job = {"db": db, "pending": pending, "timings": timings, "mailbox": mailbox, "done": threading.Event()}
+        with self._lock:
+            self._pending[mailbox] = self._pending.get(mailbox, 0) + len(pending)
+        self._queue.put(job)
+        job['done'].wait()
+        if 'error' in job:
+            raise job['error']
+        return job['result']
+
+    def depth(self, mailbox: str = None) -> int:
+        with self._lock:
+            return self._pending.get(mailbox, 0) if mailbox is not None else sum(self._pending.values())
+
+    def stats(self):
+        with self._lock:
+            pending = {mailbox: count for mailbox, count in self._pending.items() if count}
+        return {"workers": self.workers, "max_batch": self.max_batch, "pending_emails": pending}
+
+    def _next_jobs(self):
+        jobs = [self._queue.get()]
+        size = len(jobs[0]['pending'])
+        while size < self.max_batch:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            jobs.append(job)
+            size += len(job['pending'])
+        return jobs
+
+    def _work(self):
+        while True:
+            jobs = self._next_jobs()
+            merged = [item for job in jobs for item in job['pending']]
+            try:
+                start = time.perf_counter()
+                analyses, embeddings = analyze_pending(merged)
+                elapsed = time.perf_counter() - start
+                metrics.inc("mail_inference_calls_total", batches=len(jobs))
+            except Exception as e:
+                analyses = None
+                for job in jobs:
+                    job['error'] = e
+
+            offset = 0
+            for job in jobs:
+                count = len(job['pending'])
+                try:
+                    if analyses is not None:
+                        job['timings'].add("analyze", elapsed)
+                        job['result'] = store_analyzed(
+                            job['db'], job['pending'], analyses[offset:offset + count], embeddings[offset:offset + count], job['timings']
+                        )
+                except Exception as e:
+                    job['error'] = e
+                finally:
+                    offset += count
+                    with self._lock:
+                        self._pending[job['mailbox']] -= count
+                    job['done'].set()
+
+inference_pool = InferencePool()
+
+class SyncPipeline:
+    """
+    Two-stage sync: a bounded thread pool fetches full messages and feeds a
+    bounded queue, while a single thread drains it in batches into the shared
+    inference pool. Network waits therefore overlap with model work instead of alternating.
+    """
+
+    _DONE = object()
+
+    def __init__(self, client: GmailClient, db, concurrency: int = None, batch_size: int = None, mailbox: str = DEFAULT_MAILBOX):
+        self.client = client
+        self.db = db
+        self.mailbox = mailbox
+        self.concurrency = max(1, concurrency or GMAIL_FETCH_CONCURRENCY)
+        self.batch_size = max(1, batch_size or SUMMARY_BATCH_SIZE)
+        self.timings = StageTimings()
+        self.stored = 0
+        self.fetch_failures = 0
+        self.skipped = 0
+        self.persist_failures = 0
+        self._failure_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=self.concurrency * 4)
+        self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="gmail-fetch")
+        self._futures = []
+        self._inference_error = None
+        self._consumer = threading.Thread(target=self._drain, name="sync-inference", daemon=True)
+        self._consumer.start()
+
+    def _fetch(self, msg_id):
+        try:
+            with self.timings.stage("fetch"), metrics.time("gmail_get"):
+                message = call_with_backoff(self.client.get_message, msg_id)
+            self._queue.put(parse_message(msg_id, message, self.client))
+        except Exception as e:
+            if _is_gone(e):
+                # Counted apart from failures so a deleted message never pins the history checkpoint
+                print(f"⚠️ Skipped ({msg_id}): message no longer exists.")
+                metrics.inc("mail_gmail_skipped_total")
+                with self._failure_lock:
+                    self.skipped += 1
+                return
+            print(f"❌ Fetch Error ({msg_id}): {e}")
+            with self._failure_lock:
+                self.fetch_failures += 1
+
+    def _drain(self):
+        done = False
+        while not done:
+            batch = [self._queue.get()]
+            # Linger briefly so slow downloads still form full batches
+            deadline = time.monotonic() + INFERENCE_LINGER_SECONDS
+            while batch[-1] is not self._DONE and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if batch[-1] is self._DONE:
+                done = True
+                batch.pop()
+            if batch and self._inference_error is None:
+                try:
+                    stored, failed = inference_pool.run(self.db, batch, self.timings, self.mailbox)
+                    self.stored += stored
+                    self.persist_failures += failed
+                except Exception as e:
+                    print(f"❌ Inference Stage Error: {e}")
+                    self._inference_error = e
+
+    def depth(self):
+        """Messages still downloading and downloaded messages waiting for inference."""
+        return {"fetching": sum(1 for future in list(self._futures) if not future.done()), "parsed": self._queue.qsize()}
+
+    def submit(self, msg_ids):
+        """Queues new message ids for fetching; returns immediately."""
+        for msg_id in msg_ids:
+            self._futures.append(self._pool.submit(self._fetch, msg_id))
+
+    def finish(self):
+        """Waits for every fetch and the inference stage to complete, then returns the run summary."""
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._pool.shutdown(wait=True)
+            self._queue.put(self._DONE)
+            self._consumer.join()
+        if self._inference_error is not None:
+            raise self._inference_error
+        return {
+            "stored": self.stored,
+            "fetch_failures": self.fetch_failures,
+            "skipped": self.skipped,
+            "persist_failures": self.persist_failures,
+            "timings": self.timings.summary()
+        }
+
+active_pipelines = {} # mailbox -> SyncPipeline of its running sync
+
+def sync_and_analyze_emails(client: GmailClient = None, mailbox: str = DEFAULT_MAILBOX, run_id: str = None):
+    """
+    Background task to pull new emails, analyze them, and save to DB.
+    Uses Gmail history since the stored checkpoint and falls back to a full
+    list-based resync when there is no checkpoint or it has expired.
+    The run and its stage timings are recorded in sync_runs under run_id.
+    """
+    run_id = sync_runs.start(mailbox, run_id)
+    started = time.perf_counter()
+
+    def fail(reason: str, **fields):
+        metrics.inc("mail_sync_runs_total", status="failed")
+        sync_runs.finish(run_id, "failed", error=reason, seconds=round(time.perf_counter() - started, 3), **fields)
+
+    # A sync during cold start would store default labels, so wait for the models first
+    if not models_ready.wait(timeout=MODEL_READY_TIMEOUT):
+        print("Sync Failed: models are still loading.")
+        fail("models are still loading")
+        return
+    db = ai_resources.get('db')
+    if client is None:
+        client = sync_scheduler.client_for(mailbox)
+    if client is None or db is None:
+        print("Sync Failed: Service/DB not available.")
+        fail("Gmail service or database not available")
+        return
+
+    pipeline = None
+    full_sync = False
+    try:
+        start_history_id = sync_checkpoints.get(mailbox)
+        result = {}
+        full_sync = start_history_id is None
+        pipeline = SyncPipeline(client, db, mailbox=mailbox)
+        active_pipelines[mailbox] = pipeline
+
+        def feed(pages):
+            while True:
+                with pipeline.timings.stage("list"):
+                    page_ids = next(pages, None)
+                if page_ids is None:
+                    return
+                with pipeline.timings.stage("dedup"):
+                    new_ids = filter_unseen_message_ids(db, page_ids)
+                pipeline.submit(new_ids)
+
+        try:
+            if not full_sync:
+                try:
+                    feed(iter_history_pages(client, start_history_id, result))
+                except HistoryExpiredError:
+                    print(f"⚠️ History checkpoint {start_history_id} expired. Falling back to a full resync.")
+                    full_sync = True
+
+            if full_sync:
+                # Take the checkpoint before listing so mail arriving mid-sync is picked up next time
+                with metrics.time("gmail_profile"):
+                    result['history_id'] = call_with_backoff(client.get_profile).get('historyId')
+                feed(iter_full_sync_pages(client))
+        finally:
+            run = pipeline.finish()
+
+        # Messages that failed to download or save are retried by replaying from the old checkpoint next time
+        if result.get('history_id') and run['fetch_failures'] == 0 and run['persist_failures'] == 0:
+            sync_checkpoints.set(mailbox, result['history_id'])
+
+        mode = "full" if full_sync else "incremental"
+        elapsed = time.perf_counter() - started
+        metrics.observe("mail_sync_seconds", elapsed, mode=mode)
+        metrics.inc("mail_sync_runs_total", status="succeeded")
+        summary = {"mode": mode, "history_id": result.get('history_id'), **run}
+        sync_runs.finish(run_id, "succeeded", seconds=round(elapsed, 3), **summary)
+        print(f"✅ GMail Sync Complete! ({mode}, {run['stored']} new emails, timings: {run['timings']})")
+        return {"run_id": run_id, **summary}
+        
+    except HttpError as error:
+        print(f"❌ GMail API Error: {error}")
+        print("Hint: Check if the GMAIL_TOKEN_FILE exists and is valid.")
+        fail(f"Gmail API error: {error}", timings=pipeline.timings.summary() if pipeline else {})
+    except Exception as e:
+        print(f"❌ Sync Error: {e}")
+        fail(str(e), timings=pipeline.timings.summary() if pipeline else {})
+    finally:
+        active_pipelines.pop(mailbox, None)
+
+# --- MULTI-MAILBOX SYNC SCHEDULER ---
+def load_mailboxes(path: str = MAILBOXES_FILE) -> dict:
+    """Reads the mailboxes to sync. Without a config file only DEFAULT_MAILBOX is synced, from GMAIL_TOKEN_FILE."""
+    entries = [{"name": DEFAULT_MAILBOX, "token_file": GMAIL_TOKEN_FILE}]
+    if path and os.path.exists(path):
+        with open(path) as f:
+            entries = json.load(f)
+    mailboxes = {}
+    for entry in entries:
+        name = entry['name']
+        mailboxes[name] = {
+            "token_file": entry.get('token_file', GMAIL_TOKEN_FILE if name == DEFAULT_MAILBOX else f"gmail_token_{name}.json"),
+            "interval_seconds": float(entry.get('interval_seconds', SYNC_INTERVAL_SECONDS)),
+            "quota_units_per_second": float(entry.get('quota_units_per_second', GMAIL_QUOTA_UNITS_PER_SECOND)),
+            "quota_burst": float(entry.get('quota_burst', GMAIL_QUOTA_BURST)),
+        }
+    return mailboxes
+
+class SyncScheduler:
+    """
+    Runs Gmail syncs for every configured mailbox, on a timer and on demand,
+    with at most one run per mailbox at a time. A trigger during a run queues
+    a single follow-up run rather than a second concurrent one, so syncs of
+    the same mailbox never race on dedup or the history checkpoint. Each
+    mailbox draws Gmail calls from its own quota bucket; model work goes
+    through the shared inference_pool.
+    """
+
+    def __init__(self, mailboxes: dict, max_concurrent: int = None):
+        self.max_concurrent = max(1, max_concurrent or SYNC_MAX_CONCURRENT_MAILBOXES)
+        self._lock = threading.Lock()
+        self._mailboxes = {
+            name: {
+                "config": config,
+                "bucket": TokenBucket(config['quota_units_per_second'], config['quota_burst']),
+                "running": None,  # run id submitted and not yet finished
+                "follow_up": None, # run id queued behind it
+                "next_run_at": None,
+                "last_run_id": None,
+            }
+            for name, config in mailboxes.items()
+        }
+        self._pool = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix="mailbox-sync")
+        self._ticker = None
+
+    @property
+    def mailboxes(self):
+        return list(self._mailboxes)
+
+    def client_for(self, mailbox: str):
+        """Builds a rate-limited Gmail client for the mailbox, or None if it is unknown or not authorized."""
+        state = self._mailboxes.get(mailbox)
+        if state is None:
+            print(f"Sync Failed: unknown mailbox '{mailbox}'.")
+            return None
+        token_file = state['config']['token_file']
+        service = get_gmail_service(token_file)
+        if service is None:
+            return None
+        client = GoogleGmailClient(service, service_factory=lambda: get_gmail_service(token_file))
+        return RateLimitedGmailClient(client, state['bucket'], mailbox)
+
+    def trigger(self, mailbox: str):
+        """
+        Starts a sync of the mailbox, or queues one behind the run in progress.
+        Returns (run_id, coalesced); coalesced is True when a follow-up was already queued.
+        Raises KeyError for an unknown mailbox.
+        """
+        with self._lock:
+            state = self._mailboxes[mailbox]
+            if state['follow_up'] is not None:
+                return state['follow_up'], True
+            run_id = sync_runs.start(mailbox, status="queued")
+            interval = state['config']['interval_seconds']
+            if interval > 0:
+                state['next_run_at'] = time.time() + interval
+            if state['running'] is not None:
+                state['follow_up'] = run_id
+                return run_id, False
+            state['running'] = run_id
+        self._pool.submit(self._run, mailbox, run_id)
+        return run_id, False
+
+    def _run(self, mailbox: str, run_id: str):
+        try:
+            sync_and_analyze_emails(mailbox=mailbox, run_id=run_id)
+        except Exception as e:
+            print(f"❌ Scheduled Sync Error ({mailbox}): {e}")
+        finally:
+            with self._lock:
+                state = self._mailboxes[mailbox]
+                state['last_run_id'] = run_id
+                interval = state['config']['interval_seconds']
+                if interval > 0:
+                    state['next_run_at'] = time.time() + interval
+                state['running'], state['follow_up'] = state['follow_up'], None
+                follow_up = state['running']
+            if follow_up is not None:
+                self._pool.submit(self._run, mailbox, follow_up)
+
+    def start(self):
+        """Starts the periodic ticker; every mailbox with an interval syncs once right away."""
+        with self._lock:
+            if self._ticker is not None:
+                return
+            periodic = [state for state in self._mailboxes.values() if state['config']['interval_seconds'] > 0]
+            if not periodic:
+                return
+            for state in periodic:
+                state['next_run_at'] = time.time()
+            self._ticker = threading.Thread(target=self._tick, name="sync-scheduler", daemon=True)
+            self._ticker.start()
+        print(f"✅ Sync Scheduler Started ({len(periodic)} of {len(self._mailboxes)} mailboxes on a timer).")
+
+    def _tick(self):
+        while True:
+            now = time.time()
+            with self._lock:
+                due = [
+                    name for name, state in self._mailboxes.items()
+                    if state['next_run_at'] is not None and state['next_run_at'] <= now and state['running'] is None
+                ]
+            for name in due:
+                self.trigger(name)
+            time.sleep(SCHEDULER_TICK_SECONDS)
+
+    def status(self, mailbox: str = None):
+        """Per-mailbox run state, schedule, queue depth and quota bucket. Raises KeyError for an unknown mailbox."""
+        names = [mailbox] if mailbox is not None else self.mailboxes
+        with self._lock:
+            states = {name: dict(self._mailboxes[name]) for name in names}
+        report = []
+        for name, state in states.items():
+            run = sync_runs.get(state['running']) if state['running'] else None
+            last = sync_runs.get(state['last_run_id']) if state['last_run_id'] else None
+            pipeline = active_pipelines.get(name)
+            config = state['config']
+            report.append({
+                "mailbox": name,
+                "state": run.get('status', "queued") if run else "idle",
+                "run_id": state['running'],
+                "follow_up_run_id": state['follow_up'],
+                "interval_seconds": config['interval_seconds'],
+                "next_run_at": datetime.fromtimestamp(state['next_run_at']).isoformat() if state['next_run_at'] else None,
+                "last_run": {key: last.get(key) for key in ("run_id", "status", "mode", "stored", "finished_at", "error")} if last else None,
+                "queue_depth": {**(pipeline.depth() if pipeline else {"fetching": 0, "parsed": 0}), "inference": inference_pool.depth(name)},
+                "rate_limit": {
+                    "quota_units_per_second": config['quota_units_per_second'],
+                    "available_units": round(state['bucket'].available(), 1),
+                    "waited_seconds": round(state['bucket'].waited, 3),
+                },
+            })
+        return report
+
+sync_scheduler = SyncScheduler(load_mailboxes())
+metrics.gauge("mail_mailbox_sync_active", "1 while a mailbox has a sync queued or running.",
+              lambda: {(("mailbox", status['mailbox']),): int(status['run_id'] is not None) for status in sync_scheduler.status()})
+metrics.gauge("mail_mailbox_queue_depth", "Messages of a mailbox's running sync still downloading, parsed, or in inference.",
+              lambda: {(("mailbox", status['mailbox']), ("stage", stage)): depth
+                       for status in sync_scheduler.status() for stage, depth in status['queue_depth'].items()})
+
+# --- API ENDPOINTS ---
+
+@app.post("/sync-gmail")
+def sync_gmail_endpoint(mailbox: str = Query(DEFAULT_MAILBOX)):
+    """
+    Triggers the GMail sync and AI processing of one mailbox in the background.
+    If that mailbox is already syncing, a single follow-up run is queued instead.
+    Poll GET /sync-runs/{run_id} for its progress and stage timings.
+    """
+    try:
+        run_id, coalesced = sync_scheduler.trigger(mailbox)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown mailbox '{mailbox}'.")
+    message = "A sync is already queued for this mailbox." if coalesced else "Sync started in background. Check dashboard in a moment."
+    return {"message": message, "run_id": run_id, "mailbox": mailbox}
+
+@app.get("/mailboxes")
+def list_mailboxes():
+    """Sync state, schedule, queue depth and Gmail quota bucket of every mailbox, plus the shared inference pool."""
+    return {"mailboxes": sync_scheduler.status(), "inference": inference_pool.stats()}
+
+@app.get("/mailboxes/{mailbox}")
+def get_mailbox(mailbox: str):
+    try:
+        return sync_scheduler.status(mailbox)[0]
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown mailbox '{mailbox}'.")
+
+@app.get("/sync-runs")
+def list_sync_runs(limit: int = Query(20, ge=1, le=SYNC_RUN_HISTORY)):
+    return {"runs": sync_runs.recent(limit)}
+
+@app.get("/sync-runs/{run_id}")
+def get_sync_run(run_id: str):
+    run = sync_runs.get(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Unknown sync run.")
+    return run
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus scrape endpoint: stage latency histograms, error and fallback counters, queue gauges."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/healthz")
+def healthz():
+    """Liveness: the process is up. Also reports which components have loaded."""
+    with _load_status_lock:
+        components = {name: dict(status) for name, status in load_status.items()}
+    return {"status": "ok", "ready": is_ready(), "components": components}
+
+@app.get("/readyz")
+def readyz(response: Response):
+    """Readiness: 200 once the database and all models are loaded, 503 until then."""
+    ready = is_ready()
+    if not ready:
+        response.status_code = 503
+    with _load_status_lock:
+        components = {name: load_status.get(name, {}).get('state') for name in READINESS_COMPONENTS}
+    return {"ready": ready, "components": components}
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    cache = ai_resources.get('analysis_cache')
+    if cache is None:
+        raise HTTPException(status_code=503, detail="Analysis cache unavailable.")
+    return cache.stats()
+
+@app.get("/embeddings/stats")
+def get_embedding_stats():
+    store = ai_resources.get('embedding_store')
+    if store is None:
+        raise HTTPException(status_code=503, detail="Embedding store unavailable.")
+    return store.stats()
+
+@app.get("/summaries/queue")
+def get_summary_queue():
+    summary_queue = ai_resources.get('summary_queue')
+    if summary_queue is None:
+        return {"mode": SUMMARY_MODE}
+    return {"mode": SUMMARY_MODE, **summary_queue.stats()}
+
+@app.get("/models")
+def list_model_versions():
+    registry = ai_resources.get('model_registry')
+    if registry is None:
+        raise HTTPException(status_code=503, detail="Model registry unavailable.")
+    registry.discover()
+    return {"active": registry.active, "analysis_version": current_model_version(), "versions": registry.describe()}
+
+@app.post("/models/{version}/activate")
+def activate_model_version(version: str):
+    """Hot-swaps the classifier set. Requests already running finish on the old set."""
+    registry = ai_resources.get('model_registry')
+    if registry is None:
+        raise HTTPException(status_code=503, detail="Model registry unavailable.")
+    registry.discover()
+    try:
+        meta = registry.activate(version)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"msg": f"Model version '{version}' is now active.", "model": meta}
+
+@app.get("/shadow/report")
+def get_shadow_report():
+    return shadow_evaluator.report()
+
+@app.post("/shadow")
+def configure_shadow(config: ShadowConfig):
+    """Starts, retargets or (with no version) stops shadow evaluation. Counters reset on every call."""
+    try:
+        shadow_evaluator.configure(config.version, config.sample_rate)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except (FileNotFoundError, RuntimeError) as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return shadow_evaluator.report()
+
+@app.post("/rules/reload")
+def reload_rules():
+    if not rule_engine.reload():
+        raise HTTPException(status_code=400, detail="Rules file is invalid; previous rules are still active.")
+    return {"msg": "Rules reloaded."}
+
+@app.get("/emails")
+def get_emails(
+    response: Response,
+    filter_priority: str = None,
+    filter_sentiment: str = None,
+    limit: int = Query(EMAILS_PAGE_SIZE, ge=1, le=EMAILS_MAX_PAGE_SIZE),
+    cursor: str = None,
+    fields: str = None,
+    include_body: bool = True,
+    format: str = Query("json", pattern="^(json|ndjson)$")
+):
+    """
+    Lists emails newest-first, one page at a time. The cursor for the next page
+    is returned in the X-Next-Cursor header. `fields` projects email columns
+    (e.g. list views can drop body_content) and format=ndjson streams every
+    matching email page by page for exports.
+    """
+    # --- New Feature: Retrieval Augmentation/Caching ---
+    db = ai_resources.get('db')
+    if db is None:
+        raise HTTPException(status_code=503, detail="Database service unavailable.")
+
+    if format == "ndjson":
+        # Validate up front so a bad request fails before the stream starts
+        _email_select(fields, include_body)
+        if cursor:
+            decode_cursor(cursor)
+
+        def stream_pages():
+            page_cursor = cursor
+            while True:
+                rows, page_cursor = fetch_email_page(
+                    db, limit, page_cursor, filter_priority, filter_sentiment, fields, include_body
+                )
+                for item in format_email_rows(rows):
+                    yield json.dumps(item, default=str) + "\n"
+                if page_cursor is None:
+                    break
+
+        return StreamingResponse(stream_pages(), media_type="application/x-ndjson")
+
+    rows, next_cursor = fetch_email_page(db, limit, cursor, filter_priority, filter_sentiment, fields, include_body)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return format_email_rows(rows)
+
+@app.post("/escalate/{email_id}")
 def escalate_email(email_id: int, request: EscalationRequest):
     db = ai_resources.get('db')
     if db is None:
@@ -406,10 +3279,12 @@ def escalate_email(email_id: int, request: EscalationRequest):
             # --- Capture Resolution Details (The Caching Step) ---
             resolution_text = f"Issue resolved via {request.user_role} review. Standard action taken."
             
-            db.table("email_analysis").update({
+            resolved_at = datetime.now().isoformat()
+            update_res = db.table("email_analysis").update({
                 "final_resolution_details": resolution_text,
-                "resolved_at": datetime.now().isoformat()
+                "resolved_at": resolved_at
             }).eq("email_id", email_id).execute()
+            index_resolved_email(email_id, update_res.data[0] if update_res.data else {}, resolution_text, resolved_at)
             
             return {"msg": "Resolved and Cached by Team"}
         
@@ -422,9 +3297,6 @@ def escalate_email(email_id: int, request: EscalationRequest):
 
 
 
-
-from flask import Flask
-app = Flask(__name__)
-
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=10000)
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=10000)
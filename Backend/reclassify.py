@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from main import (
+    DB_WRITE_CHUNK_SIZE, EMBEDDING_STORE_DIR, SUMMARY_BATCH_SIZE, SUPABASE_KEY, SUPABASE_URL,
+    EmbeddingStore, ModelRegistry, SentenceTransformer, ai_resources, analysis_row, bulk_upsert, create_client,
+    create_summarizer, run_analysis_batch
+)
+
+# --- CONFIGURATION ---
+CHECKPOINT_FILE = "reclassify_state.json"
+PAGE_SIZE = DB_WRITE_CHUNK_SIZE
+
+# --- CHECKPOINT ---
+def load_checkpoint(path, run_key, restart=False):
+    """Resumes the run for the same model version and options, otherwise starts from the first email."""
+    if not restart and os.path.exists(path):
+        with open(path) as f:
+            state = json.load(f)
+        if state.get("run_key") == run_key:
+            return state
+        print(f"⚠️ Checkpoint in '{path}' is for '{state.get('run_key')}'. Starting over.")
+    return {"run_key": run_key, "last_id": 0, "processed": 0, "failed_ids": [], "started_at": datetime.now().isoformat()}
+
+def save_checkpoint(path, state):
+    state["updated_at"] = datetime.now().isoformat()
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+# --- READING THE CORPUS ---
+def _received_dt(value):
+    """Stored timestamps come back timezone-aware; the pipeline works in naive local time."""
+    try:
+        dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return datetime.now()
+    return dt.astimezone().replace(tzinfo=None) if dt.tzinfo else dt
+
+def iter_email_pages(db, page_size, after_id=0, limit=None):
+    """Streams emails in id order with keyset pagination, so each page is an index range scan."""
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = page_size if remaining is None else min(page_size, remaining)
+        rows = db.table("emails").select("id, body_content, received_at").gt("id", after_id).order("id").limit(size).execute().data or []
+        if not rows:
+            return
+        yield rows
+        after_id = rows[-1]["id"]
+        if remaining is not None:
+            remaining -= len(rows)
+        if len(rows) < size:
+            return
+
+def iter_failed_pages(db, failed_ids, page_size):
+    """Yields (requested ids, rows) for emails that failed in an earlier run; ids deleted since come back without rows."""
+    failed_ids = list(dict.fromkeys(failed_ids))
+    for start in range(0, len(failed_ids), page_size):
+        ids = failed_ids[start:start + page_size]
+        rows = db.table("emails").select("id, body_content, received_at").in_("id", ids).order("id").execute().data or []
+        yield ids, rows
+
+# --- WORKERS ---
+def init_worker(version, summarize, threads):
+    """Loads the models once per worker process."""
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+    registry = ModelRegistry()
+    registry.discover()
+    ai_resources['model_registry'] = registry
+    registry.activate(version)
+    ai_resources['embedder'] = SentenceTransformer('all-MiniLM-L6-v2')
+    if summarize:
+        ai_resources['summarizer'] = create_summarizer()
+
+def analyze_page(page, summarize, batch_size):
+    """Relabels one page. Returns its email_analysis rows and the vectors that had to be encoded."""
+    ids = page["ids"]
+    analyses, vecs = run_analysis_batch(
+        page["texts"], [_received_dt(value) for value in page["received_at"]], batch_size=batch_size,
+        return_embeddings=True, summarize=summarize, embeddings=page["vecs"]
+    )
+    fresh = [(email_id, vec) for email_id, vec, known in zip(ids, vecs, page["vecs"]) if known is None and vec is not None]
+    return {
+        "rows": [analysis_row(email_id, analysis, include_summary=summarize) for email_id, analysis in zip(ids, analyses)],
+        "fresh_vecs": fresh,
+    }
+
+# --- DRIVER ---
+def reclassify(db, store, version, args):
+    run_key = f"{version}|summarize={args.summarize}"
+    state = load_checkpoint(args.checkpoint, run_key, restart=args.restart)
+    retry_ids = list(state["failed_ids"])
+    if retry_ids:
+        print(f"⏳ Retrying {len(retry_ids)} email(s) that failed last time...")
+    print(f"⏳ Relabelling emails after id {state['last_id']} with '{version}' on {args.workers} worker(s)...")
+
+    threads = max(1, (os.cpu_count() or 1) // args.workers) if args.workers > 1 else None
+    pool_type = ProcessPoolExecutor if args.workers > 1 else ThreadPoolExecutor
+    started = time.perf_counter()
+    done_this_run = 0
+    in_flight = deque()
+
+    def make_page(rows):
+        ids = [row["id"] for row in rows]
+        return {
+            "ids": ids,
+            "texts": [row.get("body_content") or "" for row in rows],
+            "received_at": [row.get("received_at") for row in rows],
+            "vecs": store.get_many(ids) if store is not None else [None] * len(ids),
+        }
+
+    def clear_failed(ids):
+        retried = set(ids)
+        state["failed_ids"] = [email_id for email_id in state["failed_ids"] if email_id not in retried]
+
+    def collect():
+        nonlocal done_this_run
+        last_id, retried_ids, future = in_flight.popleft()
+        result = future.result()
+        if store is not None and result["fresh_vecs"]:
+            store.put_many([email_id for email_id, _ in result["fresh_vecs"]], [vec for _, vec in result["fresh_vecs"]])
+        _, failed = bulk_upsert(db, "email_analysis", result["rows"], on_conflict="email_id")
+        if retried_ids is not None:
+            # A retry page was already counted in `processed`; only its failures change
+            clear_failed(retried_ids)
+        else:
+            # Pages complete in submission order, so the checkpoint only ever covers finished work
+            state["last_id"] = last_id
+            state["processed"] += len(result["rows"])
+        state["failed_ids"].extend(row["email_id"] for row in failed)
+        save_checkpoint(args.checkpoint, state)
+        done_this_run += len(result["rows"]) - len(failed)
+        rate = done_this_run / max(time.perf_counter() - started, 1e-9)
+        position = "Retried earlier failures" if retried_ids is not None else f"Up to id {last_id}"
+        print(f"✅ {position}: {state['processed']} relabelled, {len(state['failed_ids'])} failed ({rate:.1f} emails/s).")
+
+    def submit(pool, rows, retried_ids=None):
+        in_flight.append((rows[-1]["id"], retried_ids, pool.submit(analyze_page, make_page(rows), args.summarize, args.batch_size)))
+        # Keep every worker busy without reading the whole table into memory
+        if len(in_flight) >= args.workers * 2:
+            collect()
+
+    with pool_type(max_workers=args.workers, initializer=init_worker, initargs=(version, args.summarize, threads)) as pool:
+        for ids, rows in iter_failed_pages(db, retry_ids, args.page_size):
+            if rows:
+                submit(pool, rows, retried_ids=ids)
+            else:
+                clear_failed(ids)
+                save_checkpoint(args.checkpoint, state)
+        for rows in iter_email_pages(db, args.page_size, state["last_id"], args.limit):
+            submit(pool, rows)
+        while in_flight:
+            collect()
+
+    elapsed = time.perf_counter() - started
+    print(f"✅ Reclassification Complete: {done_this_run} emails in {elapsed:.1f}s, {len(state['failed_ids'])} failed in total.")
+    return state
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-run the classifiers over every stored email and upsert the new labels.")
+    parser.add_argument("--version", default=None, help="Model version to label with (see GET /models). Defaults to the one the server would activate.")
+    parser.add_argument("--summarize", action="store_true", help="Also regenerate summaries (much slower).")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes running the models.")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="Emails read, classified and upserted per page.")
+    parser.add_argument("--batch-size", type=int, default=SUMMARY_BATCH_SIZE, help="Summarizer batch size.")
+    parser.add_argument("--limit", type=int, default=None, help="Stop after N emails.")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE)
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start from the first email.")
+    parser.add_argument("--no-embedding-store", action="store_true", help="Re-encode every email instead of reusing stored vectors.")
+    args = parser.parse_args()
+    args.workers = max(1, args.workers)
+
+    registry = ModelRegistry()
+    registry.discover()
+    if args.version is None:
+        try:
+            args.version = registry.default_version()
+        except FileNotFoundError as e:
+            parser.error(str(e))
+    elif args.version not in registry.versions or registry.versions[args.version]['missing']:
+        parser.error(f"model version '{args.version}' is unknown or incomplete; available: {', '.join(registry.versions)}")
+
+    db = create_client(SUPABASE_URL, SUPABASE_KEY)
+    store = None if args.no_embedding_store else EmbeddingStore(EMBEDDING_STORE_DIR)
+    reclassify(db, store, args.version, args)
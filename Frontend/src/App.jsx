@@ -541,21 +541,28 @@ const App = () => {
   const fetchEmails = async () => {
     setLoading(true);
     try {
-      let url = `${API_URL}/emails`;
+      const params = new URLSearchParams({ limit: '1000' });
       // --- ADVANCED FILTERING LOGIC ---
       // The filter state can hold 'all', 'negative', or a specific priority/intent value
       if (filter === 'high' || filter === 'medium' || filter === 'low') {
-         url += `?filter_priority=${filter}`;
+         params.set('filter_priority', filter);
       } else if (filter === 'negative') {
-         url += `?filter_sentiment=negative`;
+         params.set('filter_sentiment', 'negative');
       }
       // Note: Intent filters are handled client-side below.
 
-      const res = await fetch(url);
-      if (res.status === 404) {
-          throw new Error('Backend endpoints not yet available. Loading models...');
-      }
-      const rawData = await res.json();
+      // The backend pages its results; follow X-Next-Cursor until the last page
+      let rawData = [];
+      let cursor = null;
+      do {
+        if (cursor) params.set('cursor', cursor);
+        const res = await fetch(`${API_URL}/emails?${params}`);
+        if (res.status === 404) {
+            throw new Error('Backend endpoints not yet available. Loading models...');
+        }
+        rawData = rawData.concat(await res.json());
+        cursor = res.headers.get('X-Next-Cursor');
+      } while (cursor);
 
       // --- CLIENT-SIDE FILTERING (For Intent & Sentiment) ---
       let filteredData = rawData;